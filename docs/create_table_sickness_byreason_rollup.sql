@@ -0,0 +1,36 @@
+--CREATE TABLE STATEMENT--
+--For the pre-aggregated By Reason sickness rates (maintained by the load 
+--process). level is "org" or "ics" and area_code / area_name are the org or ICS
+CREATE TABLE [Data_Lab_NCL_Dev].[JakeK].[wf_sickness_byreason_rollup] (
+    --Date column
+    date_data DATE NOT NULL,
+
+    --Aggregation level and area
+    level VARCHAR(5) NOT NULL,
+    area_code VARCHAR(5) NOT NULL,
+    area_name VARCHAR(80) NOT NULL,
+    ics_code VARCHAR(5) NOT NULL,
+    ics_name VARCHAR(80) NOT NULL,
+
+    --Breakdown Columns
+    reason_code CHAR(3) NOT NULL,
+    reason_desc VARCHAR(60) NOT NULL,
+    staffgroup VARCHAR(60) NOT NULL,
+
+    --Metric Numerator, Denominator and Rate for the month
+    days_lost_reason FLOAT,
+    days_available FLOAT,
+    sickness_rate FLOAT,
+
+    --Rolling 12 month Numerator, Denominator and Rate
+    days_lost_reason_12m FLOAT,
+    days_available_12m FLOAT,
+    sickness_rate_12m FLOAT,
+    months_12m INT NOT NULL,
+
+    --Timestamp
+    date_upload DATETIME NOT NULL
+
+    --Primary Key Restriction
+    PRIMARY KEY (date_data, level, area_code, reason_code, staffgroup)
+);
@@ -0,0 +1,10 @@
+import os
+import sys
+
+#Entry point for running the pipeline as a package from the project directory
+#   python src [scrape|process|load|archive|rebuild|watch|run] [--force] ...
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from wf_sickness import main
+
+main()
@@ -0,0 +1,329 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import pandas as pd
+
+from datetime import datetime
+from zipfile import ZipFile, ZIP_DEFLATED
+
+#The settings are loaded from the .env and config.toml like a normal run
+import wf_sickness as wf
+
+from sqlalchemy import delete
+from utils.data_ingest import get_file_hash, read_source_file
+from utils.data_loading import bulk_insert, delta_upsert, merge_upsert
+from utils.data_scraping import data_scrape
+from utils.data_transform import build_ics_mapping, process_benchmarking_data
+from utils.rollups import refresh_rollup
+from utils.sinks import SqliteSink
+from utils.synthetic_data import (generate_source_files,
+                                  get_synthetic_ics_lookup,
+                                  serve_nhsd_fixture)
+from utils.validation import format_violations, validate_processed
+
+#Benchmark suite for the pipeline
+#Synthetic national scale NHSD files are generated and then each stage of the
+#pipeline is timed: ingest, transform, load (into a local SQLite stand-in for
+#the warehouse) and scraping (against a local HTTP stand-in for NHSD).
+#Results are appended to a history file so runs can be compared over commits.
+#
+#Usage (from the project directory):
+#   python src/benchmark.py --orgs 250 --months 3
+
+#Load methods to compare
+LOAD_METHODS = ["executemany", "multivalues", "staging_file"]
+
+#Read the command line arguments
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the wf_sickness pipeline on synthetic data.")
+    parser.add_argument("--orgs", type=int, default=250,
+                        help="Number of organisations (all regions).")
+    parser.add_argument("--months", type=int, default=3,
+                        help="Number of months of data to generate.")
+    parser.add_argument("--latency", type=float, default=0.2,
+                        help="Seconds of latency per file download.")
+    parser.add_argument("--no-memory", action="store_true",
+                        help="Skip the (slower) peak memory measurements.")
+    parser.add_argument("--history",
+                        default="./data/benchmarks/history.jsonl",
+                        help="File the results are appended to.")
+    parser.add_argument("--label", default="",
+                        help="Label stored with the results.")
+
+    return parser.parse_args()
+
+#Get the current git commit (if available)
+def get_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except Exception:
+        return None
+
+#Time a function and (optionally) run it again to measure its peak memory
+def measure(func, trace_memory=True):
+    start = time.perf_counter()
+    result = func()
+    seconds = time.perf_counter() - start
+
+    peak_mb = None
+    if trace_memory:
+        tracemalloc.start()
+        func()
+        peak_mb = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+        tracemalloc.stop()
+
+    return result, seconds, peak_mb
+
+#Add a measurement to the results for a stage
+def record(results, stage, seconds, rows, peak_mb):
+    entry = results.setdefault(stage, {"seconds": 0.0, "rows": 0,
+                                       "peak_mb": None})
+    entry["seconds"] += seconds
+    entry["rows"] += rows
+    if peak_mb is not None:
+        entry["peak_mb"] = max(entry["peak_mb"] or 0, peak_mb)
+
+#Create a local SQLite warehouse with the destination tables
+#(the same local sink used to run the pipeline without the warehouse)
+def create_warehouse(db_path, settings):
+    sink = SqliteSink("sqlite", {**settings, "sqlite_path": db_path,
+                                 "cache_directory": 
+                                     os.path.dirname(db_path) + "/"})
+    sink.connect([settings["sql_table_sickness"],
+                  settings["sql_table_byreason"],
+                  settings["sql_table_sickness_rollup"],
+                  settings["sql_table_byreason_rollup"]])
+
+    return sink.engine, sink.tables
+
+#Run the benchmarks
+def run_benchmarks(args, work_dir):
+    trace_memory = not args.no_memory
+    settings = wf.load_settings()
+    results = {}
+
+    periods = [str(period.date()) for period in
+               pd.date_range(end="2024-10-01", periods=args.months,
+                             freq="MS")]
+
+    #Generate the synthetic source files
+    source_dir = os.path.join(work_dir, "source")
+    print(f"Generating {args.months} months of data for {args.orgs} orgs...")
+    source_files = generate_source_files(source_dir, periods, args.orgs)
+
+    ics_lookup = build_ics_mapping(get_synthetic_ics_lookup(args.orgs),
+                                   settings)
+    engine, tables = create_warehouse(os.path.join(work_dir, "bench.db"),
+                                      settings)
+
+    for path in source_files:
+        file_type = "ByReason" if "reason" in path.lower() else "Sickness"
+        table = tables[settings["sql_table_" + file_type.lower()]]
+        file_size = os.path.getsize(path)
+
+        #Ingest (chunked and full reads)
+        for mode in ["chunked", "full"]:
+            settings["ingest_mode"] = mode
+            df_source, seconds, peak_mb = measure(
+                lambda: read_source_file(path, settings), trace_memory)
+            record(results, f"ingest_{mode}", seconds, len(df_source),
+                   peak_mb)
+            results[f"ingest_{mode}"].setdefault("bytes", 0)
+            results[f"ingest_{mode}"]["bytes"] += file_size
+
+        #Ingest the same file from a ZIP archive (chunked)
+        zip_path = os.path.join(work_dir, os.path.basename(path) + ".zip")
+        with ZipFile(zip_path, "w", ZIP_DEFLATED) as zip_file:
+            zip_file.write(path, os.path.basename(path))
+        settings["ingest_mode"] = "chunked"
+        df_zip, seconds, peak_mb = measure(
+            lambda: read_source_file(zip_path, settings), trace_memory)
+        record(results, "ingest_zip", seconds, len(df_zip), peak_mb)
+        results["ingest_zip"].setdefault("bytes", 0)
+        results["ingest_zip"]["bytes"] += os.path.getsize(zip_path)
+        os.remove(zip_path)
+
+        #Transform
+        df_processed, seconds, peak_mb = measure(
+            lambda: process_benchmarking_data(
+                df_source, file_type, ics_lookup, settings), trace_memory)
+        record(results, "transform", seconds, len(df_processed), peak_mb)
+
+        #Validate the processed data against the table definition
+        violations, seconds, peak_mb = measure(
+            lambda: validate_processed(df_processed, file_type, settings),
+            trace_memory)
+        if violations:
+            raise Exception(format_violations(path, violations))
+        record(results, "validate", seconds, len(df_processed), peak_mb)
+
+        #Load using each method (replacing the table content each time)
+        def load(method):
+            with engine.begin() as con:
+                con.execute(delete(table))
+                bulk_insert(con, table, df_processed, method=method,
+                            batch_size=settings["load_batch_size"],
+                            staging_dir=os.path.join(work_dir, "staging"),
+                            con_debug=False)
+
+        for method in LOAD_METHODS:
+            _, seconds, peak_mb = measure(lambda: load(method), trace_memory)
+            record(results, f"load_{method}", seconds, len(df_processed),
+                   peak_mb)
+
+        #Load using the staging table merge
+        def merge():
+            with engine.begin() as con:
+                merge_upsert(con, table, df_processed,
+                             method=settings["load_method"],
+                             batch_size=settings["load_batch_size"],
+                             con_debug=False)
+
+        _, seconds, peak_mb = measure(merge, trace_memory)
+        record(results, "load_merge", seconds, len(df_processed), peak_mb)
+
+        #Reload the same data as a delta (no rows have changed)
+        def delta():
+            with engine.begin() as con:
+                delta_upsert(con, table, df_processed,
+                             method=settings["load_method"],
+                             batch_size=settings["load_batch_size"],
+                             con_debug=False)
+
+        _, seconds, peak_mb = measure(delta, trace_memory)
+        record(results, "load_delta", seconds, len(df_processed), peak_mb)
+
+        #Recompute the rollup rows affected by the month
+        rollup_table = tables[settings["sql_table_" + file_type.lower() + 
+                                       "_rollup"]]
+        def rollup():
+            with engine.begin() as con:
+                return refresh_rollup(con, table, rollup_table, file_type,
+                                      dates=df_processed["date_data"].unique(),
+                                      method=settings["load_method"],
+                                      batch_size=settings["load_batch_size"],
+                                      con_debug=False)
+
+        rows, seconds, peak_mb = measure(rollup, trace_memory)
+        record(results, "rollup", seconds, rows, peak_mb)
+
+    #Scrape the files from a local stand-in for NHSD
+    def scrape(server, scrape_dir, backoff):
+        os.makedirs(scrape_dir, exist_ok=True)
+        return data_scrape(publication_name=settings["publication_name"],
+                           target_files=settings["target_files"],
+                           dest_dir=scrape_dir,
+                           mode="latest",
+                           mode_n=args.months,
+                           con_debug=False,
+                           url=f"http://127.0.0.1:{server.server_port}",
+                           max_workers=settings["scrape_workers"],
+                           retries=settings["scrape_retries"],
+                           backoff=backoff,
+                           timeout=settings["scrape_timeout"])
+
+    server = serve_nhsd_fixture(source_dir, periods, latency=args.latency)
+    downloaded, seconds, peak_mb = measure(
+        lambda: scrape(server, os.path.join(work_dir, "scrape") + "/",
+                       settings["scrape_backoff"]), trace_memory)
+    record(results, "scrape", seconds, 0, peak_mb)
+    results["scrape"]["files"] = len(downloaded)
+    results["scrape"]["bytes"] = sum([os.path.getsize(f) for f in downloaded])
+    server.shutdown()
+
+    #Scrape again from a stand-in that drops the connection part way through
+    #every file so each download resumes (with Range requests) more times 
+    #than the retry limit. There is no backoff so the stage times the resumes
+    #rather than the waits.
+    drop_after = max(os.path.getsize(path) for path in source_files) // (
+        settings["scrape_retries"] + 3) + 1
+    server = serve_nhsd_fixture(source_dir, periods, latency=args.latency,
+                                drop_after=drop_after)
+    downloaded, seconds, peak_mb = measure(
+        lambda: scrape(server, os.path.join(work_dir, "scrape_resume") + "/",
+                       0), trace_memory)
+    record(results, "scrape_resume", seconds, 0, peak_mb)
+    results["scrape_resume"]["files"] = len(downloaded)
+    results["scrape_resume"]["bytes"] = sum([os.path.getsize(f) 
+                                             for f in downloaded])
+    server.shutdown()
+    engine.dispose()
+
+    #The resumed downloads must match the source files byte for byte
+    source_hashes = {get_file_hash(path) for path in source_files}
+    resumed_hashes = {get_file_hash(path) for path in downloaded}
+    if resumed_hashes != source_hashes:
+        raise Exception(("The resumed downloads do not match the source "
+                         "files."))
+
+    #Work out the throughput for each stage
+    for entry in results.values():
+        entry["rows_per_sec"] = round(entry["rows"] /
+                                      max(entry["seconds"], 1e-9))
+        entry["seconds"] = round(entry["seconds"], 4)
+        if entry["peak_mb"] is not None:
+            entry["peak_mb"] = round(entry["peak_mb"], 2)
+
+    return results
+
+#Load the last run in the history with the same scale
+def get_previous_run(history_path, scale):
+    previous = None
+    if os.path.isfile(history_path):
+        with open(history_path) as file:
+            for line in file:
+                run = json.loads(line)
+                if run["scale"] == scale:
+                    previous = run
+    return previous
+
+#Print the results, comparing them against the previous run
+def print_results(results, previous):
+    print(f"\n{'stage':<20}{'seconds':>10}{'rows':>10}{'rows/sec':>12}"
+          f"{'peak MB':>10}{'vs prev':>10}")
+    for stage, entry in results.items():
+        change = ""
+        if previous and stage in previous["stages"]:
+            prev_seconds = previous["stages"][stage]["seconds"]
+            if prev_seconds > 0:
+                change = f"{(entry['seconds'] / prev_seconds - 1):+.0%}"
+        peak = entry["peak_mb"] if entry["peak_mb"] is not None else "-"
+        print(f"{stage:<20}{entry['seconds']:>10.3f}{entry['rows']:>10}"
+              f"{entry['rows_per_sec']:>12}{peak:>10}{change:>10}")
+
+def main():
+    args = parse_args()
+    scale = {"orgs": args.orgs, "months": args.months,
+             "latency": args.latency}
+
+    work_dir = tempfile.mkdtemp(prefix="wf_sickness_bench_")
+    try:
+        results = run_benchmarks(args, work_dir)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    previous = get_previous_run(args.history, scale)
+    print_results(results, previous)
+
+    #Save the results to the history file
+    os.makedirs(os.path.dirname(args.history), exist_ok=True)
+    with open(args.history, "a") as file:
+        file.write(json.dumps({
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "commit": get_commit(),
+            "label": args.label,
+            "scale": scale,
+            "stages": results
+        }) + "\n")
+    print(f"\nResults saved to {args.history}")
+
+if __name__ == "__main__":
+    main()
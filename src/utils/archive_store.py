@@ -0,0 +1,161 @@
+import gzip
+import json
+import os
+import shutil
+
+from datetime import datetime
+
+from utils.data_ingest import is_zip_file
+
+#This script stores archived source files by the hash of their content.
+#Each file is saved once (compressed) in the objects directory of the archive:
+#
+#   data/archive/objects/<first 2 characters of hash>/<hash>.csv.gz
+#
+#CSV files are gzip compressed as they are written. ZIP files are already
+#compressed so they are stored as they are (<hash>.zip).
+#The hash is the same sha256 hash used by the ingest ledger so a file that is
+#downloaded again without changing is only stored once, and files with the
+#same name never conflict.
+#index.json records the names each file was saved under, its dataset, the
+#months of its data and its revision (the files of each dataset are numbered
+#by the latest month of their data, i.e. the release, then the order they were
+#archived). NHSD republish months, sometimes in a file covering several 
+#months, so a month can be in more than one revision.
+#The stored files are read by the same functions as the source files
+#(gzip files are decompressed as they are read, see utils/data_ingest.py).
+
+#Name of the index file in the archive directory
+INDEX_FILE = "index.json"
+
+#Directory (in the archive directory) the stored files are saved in
+OBJECTS_DIR = "objects"
+
+#Size of the blocks copied when compressing a file
+COPY_CHUNK_SIZE = 1024 * 1024
+
+#Load the archive index (keyed on the file hash)
+def load_index(archive_dir):
+    index_path = os.path.join(archive_dir, INDEX_FILE)
+    if os.path.isfile(index_path):
+        with open(index_path) as file:
+            return json.load(file)
+    return {}
+
+#Save the archive index
+def save_index(index, archive_dir):
+    index_path = os.path.join(archive_dir, INDEX_FILE)
+    os.makedirs(archive_dir, exist_ok=True)
+
+    #Write to a temporary file first so the index is never left half written
+    with open(index_path + ".tmp", "w") as file:
+        json.dump(index, file, indent=2)
+    os.replace(index_path + ".tmp", index_path)
+
+#Return the path (relative to the archive directory) a file is stored at
+def get_object_path(file_hash, zipped=False):
+    extension = ".zip" if zipped else ".csv.gz"
+    return "/".join([OBJECTS_DIR, file_hash[:2], file_hash + extension])
+
+#Write a compressed copy of a file into the store
+#(written to a temporary file first so a stored file is always complete)
+def write_object(filepath, object_dest, compress_level):
+    os.makedirs(os.path.dirname(object_dest), exist_ok=True)
+
+    with open(filepath, "rb") as source:
+        if object_dest.endswith(".gz"):
+            with gzip.open(object_dest + ".tmp", "wb",
+                           compresslevel=compress_level) as dest:
+                shutil.copyfileobj(source, dest, COPY_CHUNK_SIZE)
+        else:
+            with open(object_dest + ".tmp", "wb") as dest:
+                shutil.copyfileobj(source, dest, COPY_CHUNK_SIZE)
+
+    os.replace(object_dest + ".tmp", object_dest)
+
+#Get the order of a revision: the latest month of its data (an older release
+#can be archived after a newer one, i.e. when backfilling) then when it was 
+#archived and its name so files archived in the same second keep an order
+def get_revision_order(entry):
+    return (entry["periods"][-1] if entry["periods"] else "", 
+            entry["archived"], entry["names"][0])
+
+#Number the revisions of a dataset from the oldest release to the newest
+#(files moved in from an older archive keep the time they were first archived)
+def number_revisions(index, dataset):
+    entries = [entry for entry in index.values()
+               if entry["dataset"] == dataset]
+    for revision, entry in enumerate(
+        sorted(entries, key=get_revision_order), 1):
+        entry["revision"] = revision
+
+#Add a file to the archive store and remove the original
+#The periods are the months of the data (YYYY-MM)
+#Returns whether a new copy was stored (False if the same content was already
+#in the archive)
+def store_file(filepath, file_hash, dataset, periods, archive_dir,
+               compress_level=6, archived=None):
+    index = load_index(archive_dir)
+    filename = os.path.basename(filepath)
+
+    #The same content has already been archived (i.e. a repeat download)
+    #The stored copy is written again if it is missing (i.e. it was deleted) 
+    #so the original is never removed without a copy in the store
+    if file_hash in index:
+        entry = index[file_hash]
+        object_dest = os.path.join(archive_dir, entry["object"])
+        restored = not os.path.isfile(object_dest)
+        if restored:
+            write_object(filepath, object_dest, compress_level)
+            entry["stored_size"] = os.path.getsize(object_dest)
+        if filename not in entry["names"]:
+            entry["names"].append(filename)
+        save_index(index, archive_dir)
+        os.remove(filepath)
+        return restored
+
+    object_path = get_object_path(file_hash, is_zip_file(filepath))
+    write_object(filepath, os.path.join(archive_dir, object_path),
+                 compress_level)
+
+    index[file_hash] = {
+        "object": object_path,
+        "names": [filename],
+        "dataset": dataset,
+        "periods": periods,
+        "revision": None,
+        "size": os.path.getsize(filepath),
+        "stored_size": os.path.getsize(os.path.join(archive_dir,
+                                                    object_path)),
+        "archived": (archived or datetime.now()).isoformat(timespec="seconds")
+    }
+    number_revisions(index, dataset)
+    save_index(index, archive_dir)
+
+    #The original is only removed once the copy and index are saved
+    os.remove(filepath)
+    return True
+
+#Get the revisions needed to rebuild each dataset (newest release first, the
+#order is checked again rather than trusting the numbers saved in the index)
+#A revision is only needed if it has a month that is not in a newer revision
+#(files with no known months are always kept)
+#Returns a dict of dataset to a list of [file hash, index entry]
+def get_rebuild_revisions(index):
+    revisions = {}
+    for file_hash, entry in sorted(
+        index.items(), reverse=True, 
+        key=lambda item: get_revision_order(item[1])):
+        revisions.setdefault(entry["dataset"], []).append([file_hash, entry])
+
+    for dataset, entries in revisions.items():
+        newer_periods = set()
+        needed = []
+        for file_hash, entry in entries:
+            if not entry["periods"] or not newer_periods.issuperset(
+                entry["periods"]):
+                needed.append([file_hash, entry])
+            newer_periods.update(entry["periods"])
+        revisions[dataset] = needed
+
+    return revisions
@@ -0,0 +1,251 @@
+import gzip
+import hashlib
+import json
+import os
+
+from datetime import datetime
+from functools import lru_cache
+from zipfile import ZipFile
+
+#This script handles reading the NHSD source files into memory.
+#The national files contain every English trust but only the London rows are
+#kept, so the files are read in chunks and filtered as they are parsed to keep
+#peak memory in line with the size of the London extract.
+#Loaded files are recorded in a ledger keyed on their content hash (with the
+#sinks they were loaded into) so files that have already been loaded into
+#every sink can be skipped before they are parsed.
+#Source files can also be ZIP archives (as NHSD sometimes publishes them).
+#The CSV members are parsed straight from the archive as they are decompressed
+#so no extracted copy is written to disk or held in memory.
+#Gzip compressed files (as saved in the archive store) are decompressed in the
+#same way as they are read.
+#pandas is only imported when a file is read so the ledger functions can be
+#used without it.
+
+#Size of the blocks used when hashing a file
+HASH_CHUNK_SIZE = 1024 * 1024
+
+#Magic bytes at the start of a ZIP file
+ZIP_SIGNATURE = b"PK\x03\x04"
+
+#Magic bytes at the start of a gzip file
+GZIP_SIGNATURE = b"\x1f\x8b"
+
+#Return the sha256 hash of a file's content
+def get_file_hash(filepath):
+    file_hash = hashlib.sha256()
+    with open(filepath, "rb") as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b""):
+            file_hash.update(chunk)
+
+    return file_hash.hexdigest()
+
+#The ingest ledger records every file that has been loaded into the warehouse
+#keyed on the dataset and the hash of the file content
+def load_ledger(ledger_path):
+    if os.path.isfile(ledger_path):
+        with open(ledger_path) as file:
+            return json.load(file)
+    return {}
+
+#Save the ingest ledger
+def save_ledger(ledger, ledger_path):
+    os.makedirs(os.path.dirname(ledger_path), exist_ok=True)
+
+    #Write to a temporary file first so the ledger is never left half written
+    with open(ledger_path + ".tmp", "w") as file:
+        json.dump(ledger, file, indent=2)
+    os.replace(ledger_path + ".tmp", ledger_path)
+
+#Get the ledger key for a file
+def get_ledger_key(file_hash, dataset):
+    return f"{dataset}:{file_hash}"
+
+#Sinks a file was loaded into for ledgers written before there were sinks
+#(files were only loaded into the warehouse)
+DEFAULT_LEDGER_SINKS = ["sqlserver"]
+
+#Record a loaded file in the ledger with the sinks it was loaded into
+#(added to the sinks it had already been loaded into)
+def record_ingest(ledger, file_hash, dataset, filename, rows, sinks):
+    previous = ledger.get(get_ledger_key(file_hash, dataset), {})
+    loaded_sinks = previous.get("sinks", DEFAULT_LEDGER_SINKS 
+                                if previous else [])
+
+    ledger[get_ledger_key(file_hash, dataset)] = {
+        "filename": filename,
+        "dataset": dataset,
+        "rows": rows,
+        "sinks": sorted(set(loaded_sinks) | set(sinks)),
+        "loaded": datetime.now().isoformat(timespec="seconds")
+    }
+
+#Check whether a file has been loaded into every one of the given sinks
+def is_ingested(ledger, file_hash, dataset, sinks):
+    entry = ledger.get(get_ledger_key(file_hash, dataset))
+    if entry is None:
+        return False
+    return set(sinks) <= set(entry.get("sinks", DEFAULT_LEDGER_SINKS))
+
+#Load the column map file (cached so it is only read once per run)
+@lru_cache(maxsize=None)
+def load_column_map(map_path):
+    import pandas as pd
+
+    df_map = pd.read_csv(map_path, dtype=str)
+
+    #Default to reading columns as strings if no dtype is specified
+    if "dtype" not in df_map.columns:
+        df_map["dtype"] = "str"
+    df_map["dtype"] = df_map["dtype"].fillna("str")
+
+    return df_map
+
+#Return the source column names that map to the given output column
+def get_source_columns(df_map, output_name):
+    return list(df_map[df_map["output_name"] == output_name]["source_name"])
+
+#Check whether a file is a ZIP archive (using its content not its name)
+def is_zip_file(filepath):
+    with open(filepath, "rb") as file:
+        return file.read(len(ZIP_SIGNATURE)) == ZIP_SIGNATURE
+
+#Check whether a file is gzip compressed (using its content not its name)
+def is_gzip_file(filepath):
+    with open(filepath, "rb") as file:
+        return file.read(len(GZIP_SIGNATURE)) == GZIP_SIGNATURE
+
+#Return the CSV members of an open ZIP archive
+def get_csv_members(zip_file):
+    return [member for member in zip_file.infolist() 
+            if not member.is_dir() and 
+            member.filename.lower().endswith(".csv") and
+            not member.filename.startswith("__MACOSX/")]
+
+#Read the header and the first rows of a source file (as strings)
+#Returns a list of [member name, sample frame] with one entry per CSV member
+#for ZIP archives and a single entry (with no member name) for CSV files
+def probe_source_file(filepath, n_rows=100):
+    import pandas as pd
+
+    if is_gzip_file(filepath):
+        with gzip.open(filepath) as stream:
+            return [[None, pd.read_csv(stream, nrows=n_rows, dtype=str)]]
+
+    if not is_zip_file(filepath):
+        return [[None, pd.read_csv(filepath, nrows=n_rows, dtype=str)]]
+
+    samples = []
+    with ZipFile(filepath) as zip_file:
+        for member in get_csv_members(zip_file):
+            with zip_file.open(member) as stream:
+                samples.append([member.filename,
+                                pd.read_csv(stream, nrows=n_rows, dtype=str)])
+
+    return samples
+
+#Read only the given columns of a source file (as strings)
+#Returns a list with a frame for each CSV file (only the named members of ZIP
+#archives are read when members is given)
+def read_source_columns(filepath, columns, members=None):
+    import pandas as pd
+
+    read_args = {"usecols": lambda col: col in columns, "dtype": str}
+
+    if is_gzip_file(filepath):
+        with gzip.open(filepath) as stream:
+            return [pd.read_csv(stream, **read_args)]
+
+    if not is_zip_file(filepath):
+        return [pd.read_csv(filepath, **read_args)]
+
+    frames = []
+    with ZipFile(filepath) as zip_file:
+        for member in get_csv_members(zip_file):
+            if members is None or member.filename in members:
+                with zip_file.open(member) as stream:
+                    frames.append(pd.read_csv(stream, **read_args))
+
+    return frames
+
+#Read a source file only keeping the mapped columns and London rows
+#ZIP archives are read member by member straight from the archive (only the
+#named members when members is given) and gzip files are decompressed as they
+#are read
+def read_source_file(filepath, settings, members=None):
+    import pandas as pd
+
+    if is_gzip_file(filepath):
+        with gzip.open(filepath) as stream:
+            return read_csv_source(stream, filepath, settings)
+
+    if not is_zip_file(filepath):
+        return read_csv_source(filepath, filepath, settings)
+
+    frames = []
+    with ZipFile(filepath) as zip_file:
+        csv_members = [member for member in get_csv_members(zip_file)
+                       if members is None or member.filename in members]
+        if csv_members == []:
+            raise Exception(f"The zip file {filepath} contains no csv files.")
+
+        for member in csv_members:
+            with zip_file.open(member) as stream:
+                frames.append(read_csv_source(
+                    stream, f"{filepath}/{member.filename}", settings))
+
+    return pd.concat(frames, ignore_index=True)
+
+#Read CSV data (from a path or file object) keeping the London rows
+def read_csv_source(source, source_name, settings):
+    import pandas as pd
+
+    #Load the map file
+    df_map = load_column_map(settings["map_column"])
+
+    #Only read columns that are named in the map file using explicit dtypes
+    source_columns = set(df_map["source_name"])
+    dtypes = df_map.set_index("source_name")["dtype"].to_dict()
+
+    read_args = {
+        "usecols": lambda col: col in source_columns,
+        "dtype": dtypes
+    }
+
+    #Read the whole file in one go if chunking is disabled
+    #(a file with only a header is rejected in both modes)
+    if settings["ingest_mode"] != "chunked":
+        df = pd.read_csv(source, **read_args)
+        if len(df) == 0:
+            raise Exception(f"The source file {source_name} contains no data.")
+        return filter_region(df, df_map, settings)
+
+    #Filter each chunk to London as it is read
+    chunks = []
+    rows = 0
+    with pd.read_csv(source, chunksize=settings["ingest_chunksize"],
+                     **read_args) as reader:
+        for chunk in reader:
+            rows += len(chunk)
+            chunks.append(filter_region(chunk, df_map, settings))
+
+    #(some pandas versions return an empty chunk for a file with only a header)
+    if rows == 0:
+        raise Exception(f"The source file {source_name} contains no data.")
+
+    return pd.concat(chunks, ignore_index=True)
+
+#Filter a frame (using the source column names) to the London region
+def filter_region(df, df_map, settings):
+    region_code = settings["region_code_london"]
+
+    #The region column has been named differently over time
+    region_columns = df.columns.intersection(
+        get_source_columns(df_map, "region_code"))
+
+    if len(region_columns) == 0:
+        raise Exception(("No region column was found in the source data.\n"
+                         "Check the region_code entries in the "
+                         f"{settings['map_column']} file."))
+
+    return df[df[region_columns[0]] == region_code]
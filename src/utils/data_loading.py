@@ -0,0 +1,608 @@
+import csv
+import hashlib
+import os
+import pickle
+import re
+import time
+
+import numpy as np
+import pandas as pd
+
+from utils.instrumentation import report
+from sqlalchemy import (and_, bindparam, delete, exists, insert, inspect, 
+                        literal_column, select, text, types, Column, 
+                        MetaData, Table)
+
+#This script handles writing processed data into the warehouse.
+#The rows are passed to the DB driver as plain tuples built column by column
+#so no per-row Python dicts are created. There are 3 load methods available:
+#"executemany"  - A single parameterised INSERT sent with executemany
+#                 (uses pyodbc's fast_executemany when connecting to SQL Server)
+#"multivalues"  - INSERT statements with many rows in the VALUES clause
+#"staging_file" - Writes a staging csv file and loads it with BULK INSERT
+#                 (for other databases the staging file is streamed back in)
+#Data can also be loaded as a delta (see delta_upsert) where only the rows
+#that differ from the destination are written.
+
+#Parameter limits per statement for the multivalues method
+MAX_PARAMS = {"mssql": 2099, "sqlite": 999}
+MAX_VALUES_ROWS = 1000
+
+#Create a table using one of the CREATE TABLE scripts in the docs directory
+#The database and schema in the script are replaced with the given schema so
+#the tables can be created in other databases (i.e. a local SQLite database)
+def create_table_from_ddl(con, ddl_path, schema=None):
+    with open(ddl_path) as file:
+        ddl = file.read()
+
+    #Remove comments
+    ddl = re.sub(r"--[^\n]*", "", ddl)
+
+    #Replace the [database].[schema].[table] name
+    table_prefix = f"{schema}." if schema else ""
+    ddl = re.sub(r"\[[^\]]+\]\.\[[^\]]+\]\.\[([^\]]+)\]", 
+                 table_prefix + r"\1", ddl)
+    
+    #SQL Server accepts the PRIMARY KEY constraint without a separating comma
+    ddl = re.sub(r"([^,\s])\s*PRIMARY KEY\s*\(", 
+                 r"\1,\n    PRIMARY KEY (", ddl)
+
+    con.exec_driver_sql(ddl.strip().rstrip(";"))
+
+#Build a fingerprint of the destination table definitions
+#This is much cheaper than a full reflection so it is used to check whether
+#a cached reflection is still valid
+def get_schema_fingerprint(con, schema, table_names):
+    if con.dialect.name == "mssql":
+        #Use a single information schema query on SQL Server
+        table_list = ", ".join([f"'{name}'" for name in table_names])
+        query = text(("SELECT TABLE_NAME, COLUMN_NAME, DATA_TYPE, "
+                      "CHARACTER_MAXIMUM_LENGTH, IS_NULLABLE "
+                      "FROM INFORMATION_SCHEMA.COLUMNS "
+                      "WHERE TABLE_SCHEMA = :schema "
+                      f"AND TABLE_NAME IN ({table_list}) "
+                      "ORDER BY TABLE_NAME, ORDINAL_POSITION"))
+        columns = con.execute(query, {"schema": schema}).fetchall()
+    else:
+        inspector = inspect(con)
+        columns = []
+        for name in sorted(table_names):
+            for col in inspector.get_columns(name, schema=schema):
+                columns.append((name, col["name"], str(col["type"]), 
+                                col["nullable"]))
+
+    fingerprint = hashlib.sha256()
+    fingerprint.update(str(con.engine.url).encode())
+    fingerprint.update(repr([tuple(col) for col in columns]).encode())
+
+    return fingerprint.hexdigest()
+
+#Return the reflected destination tables as a dict keyed on table name
+#Only the named tables are reflected and the result is cached on disk so
+#later runs can skip the reflection while the schema fingerprint is unchanged
+def get_tables(engine, schema, table_names, cache_path=None):
+
+    with engine.connect() as con:
+        fingerprint = get_schema_fingerprint(con, schema, table_names)
+
+        #Try to load the cached reflection
+        metadata = None
+        if cache_path and os.path.isfile(cache_path):
+            try:
+                with open(cache_path, "rb") as file:
+                    cache = pickle.load(file)
+                if cache["fingerprint"] == fingerprint:
+                    metadata = cache["metadata"]
+            except Exception:
+                metadata = None
+
+        #Reflect only the destination tables
+        if metadata is None:
+            metadata = MetaData(schema=schema)
+            metadata.reflect(bind=con, only=list(table_names))
+
+            if cache_path:
+                os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+                with open(cache_path, "wb") as file:
+                    pickle.dump({"fingerprint": fingerprint, 
+                                 "metadata": metadata}, file)
+
+    tables = {}
+    for name in table_names:
+        key = f"{schema}.{name}" if schema else name
+        if key not in metadata.tables:
+            raise Exception(f"The table {key} was not found in the database.")
+        tables[name] = metadata.tables[key]
+
+    return tables
+
+#Convert a data frame into a list of row tuples ready for the DB driver
+def frame_to_rows(df, table, dialect):
+    columns = []
+
+    for col in df.columns:
+        series = df[col]
+        col_type = table.c[col].type
+
+        #Convert to python objects one column at a time
+        if (pd.api.types.is_datetime64_any_dtype(series) and 
+            isinstance(col_type, types.Date)):
+            values = np.array(series.dt.date, dtype=object)
+        elif pd.api.types.is_datetime64_any_dtype(series):
+            values = np.array(series.dt.to_pydatetime(), dtype=object)
+        else:
+            values = series.to_numpy(dtype=object, copy=True)
+
+        #The DB driver needs missing values as None rather than NaN
+        mask = series.isna().to_numpy()
+        values[mask] = None
+
+        #Apply any conversion the destination column type requires
+        processor = col_type.bind_processor(dialect)
+        if processor is not None:
+            values = [processor(v) if v is not None else None for v in values]
+
+        columns.append(values)
+
+    return list(zip(*columns))
+
+#Get the placeholder marker for the DB driver in use
+def get_placeholder(dialect):
+    if dialect.paramstyle == "qmark":
+        return "?"
+    elif dialect.paramstyle in ("format", "pyformat"):
+        return "%s"
+    else:
+        raise Exception((f"The {dialect.paramstyle} parameter style is not "
+                         "supported by the bulk loader."))
+
+#Build the start of an insert statement for the given columns
+def build_insert_prefix(table, columns, dialect):
+    preparer = dialect.identifier_preparer
+    col_list = ", ".join([preparer.quote(col) for col in columns])
+
+    return f"INSERT INTO {preparer.format_table(table)} ({col_list}) VALUES "
+
+#Load rows using executemany with a single parameterised statement
+def load_executemany(con, table, df, batch_size):
+    dialect = con.dialect
+    rows = frame_to_rows(df, table, dialect)
+
+    marker = get_placeholder(dialect)
+    sql = (build_insert_prefix(table, df.columns, dialect) +
+           "(" + ", ".join([marker] * len(df.columns)) + ")")
+
+    batches = 0
+    for i in range(0, len(rows), batch_size):
+        con.exec_driver_sql(sql, rows[i:i+batch_size])
+        batches += 1
+
+    return batches
+
+#Load rows using INSERT statements with multiple rows in the VALUES clause
+def load_multivalues(con, table, df, batch_size):
+    dialect = con.dialect
+    rows = frame_to_rows(df, table, dialect)
+
+    #Keep each statement within the DB parameter limits
+    max_params = MAX_PARAMS.get(dialect.name, 999)
+    rows_per_stmt = max(1, min(batch_size, MAX_VALUES_ROWS,
+                               max_params // len(df.columns)))
+
+    marker = get_placeholder(dialect)
+    row_marker = "(" + ", ".join([marker] * len(df.columns)) + ")"
+    prefix = build_insert_prefix(table, df.columns, dialect)
+
+    batches = 0
+    for i in range(0, len(rows), rows_per_stmt):
+        batch = rows[i:i+rows_per_stmt]
+        sql = prefix + ", ".join([row_marker] * len(batch))
+        params = tuple([value for row in batch for value in row])
+        con.exec_driver_sql(sql, params)
+        batches += 1
+
+    return batches
+
+#Load rows by writing a staging file and bulk loading it
+def load_staging_file(con, table, df, batch_size, staging_dir):
+    dialect = con.dialect
+
+    #The staging file columns must follow the destination table order
+    table_columns = [col.name for col in table.columns]
+    missing = [col for col in table_columns if col not in df.columns]
+    if missing:
+        raise Exception((f"The data is missing the columns {missing} needed "
+                         f"for a staging file load into {table.name}."))
+
+    os.makedirs(staging_dir, exist_ok=True)
+    staging_path = os.path.abspath(
+        os.path.join(staging_dir, f"{table.name}_{os.getpid()}.csv"))
+
+    #Date only columns are written without a time component
+    df_stage = df[table_columns].copy()
+    for col in table_columns:
+        if (isinstance(table.c[col].type, types.Date) and
+            pd.api.types.is_datetime64_any_dtype(df_stage[col])):
+            df_stage[col] = df_stage[col].dt.strftime("%Y-%m-%d")
+
+    try:
+        #Write the staging file
+        df_stage.to_csv(staging_path, index=False,
+                        date_format="%Y-%m-%d %H:%M:%S")
+
+        #SQL Server reads the staging file directly
+        if dialect.name == "mssql":
+            table_name = dialect.identifier_preparer.format_table(table)
+            sql = (f"BULK INSERT {table_name} FROM '{staging_path}' "
+                   "WITH (FORMAT = 'CSV', FIRSTROW = 2, TABLOCK)")
+            con.exec_driver_sql(sql)
+            return 1
+
+        #Other databases stream the staging file back in using executemany
+        marker = get_placeholder(dialect)
+        sql = (build_insert_prefix(table, table_columns, dialect) +
+               "(" + ", ".join([marker] * len(table_columns)) + ")")
+
+        batches = 0
+        with open(staging_path, newline="") as file:
+            reader = csv.reader(file)
+            next(reader)
+            batch = []
+            for row in reader:
+                batch.append(tuple([value if value != "" else None
+                                    for value in row]))
+                if len(batch) == batch_size:
+                    con.exec_driver_sql(sql, batch)
+                    batches += 1
+                    batch = []
+            if batch:
+                con.exec_driver_sql(sql, batch)
+                batches += 1
+
+        return batches
+
+    finally:
+        if os.path.isfile(staging_path):
+            os.remove(staging_path)
+
+#Insert a data frame into a table using the specified load method
+def bulk_insert(con, table, df, method="executemany", batch_size=1000,
+                staging_dir="./data/staging/", con_debug=True):
+
+    if len(df) == 0:
+        return 0
+
+    with report.stage("bulk_insert", table=table.name, method=method, 
+                      rows_in=len(df)) as metrics:
+        start = time.perf_counter()
+
+        if method == "executemany":
+            batches = load_executemany(con, table, df, batch_size)
+        elif method == "multivalues":
+            batches = load_multivalues(con, table, df, batch_size)
+        elif method == "staging_file":
+            batches = load_staging_file(con, table, df, batch_size, 
+                                        staging_dir)
+        else:
+            raise Exception(f"The load method {method} is not supported.")
+
+        #Report the throughput so the load methods can be compared
+        duration = time.perf_counter() - start
+        metrics["batches"] = batches
+        metrics["rows_per_sec"] = round(len(df) / max(duration, 1e-9))
+
+    report.count("rows_inserted", len(df))
+    report.count("insert_batches", batches)
+
+    if con_debug:
+        print(f"Loaded {len(df)} rows into {table.name} using {method} "
+              f"in {batches} batches: {duration:.2f}s "
+              f"({len(df) / max(duration, 1e-9):,.0f} rows/sec)")
+
+    return len(df)
+
+#Create an empty temporary staging table with the same columns as the table
+def create_staging_table(con, table):
+    dialect = con.dialect
+    preparer = dialect.identifier_preparer
+
+    #SQL Server temporary tables are marked with a # prefix
+    if dialect.name == "mssql":
+        stage_name = f"#stage_{table.name}"
+        con.exec_driver_sql(f"SELECT TOP 0 * "
+                            f"INTO {preparer.quote(stage_name)} "
+                            f"FROM {preparer.format_table(table)}")
+    else:
+        stage_name = f"stage_{table.name}"
+        con.exec_driver_sql(f"DROP TABLE IF EXISTS temp.{stage_name}")
+        con.exec_driver_sql(f"CREATE TEMP TABLE {stage_name} AS "
+                            f"SELECT * FROM {preparer.format_table(table)} "
+                            "WHERE 1 = 0")
+
+    return Table(stage_name, MetaData(),
+                 *[Column(col.name, col.type) for col in table.columns])
+
+#Load a frame into a staging table and apply it to the destination table in a
+#single set based operation. All rows in the destination that share a date
+#with the staged data are replaced, for any number of dates in the data.
+#The caller is responsible for committing the transaction.
+def merge_upsert(con, table, df, date_column="date_data", method="executemany",
+                 batch_size=1000, staging_dir="./data/staging/", 
+                 con_debug=True):
+    
+    #Bulk load the data into the staging table
+    stage = create_staging_table(con, table)
+    bulk_insert(con, stage, df, method, batch_size, staging_dir, con_debug)
+
+    primary_key = [col.name for col in table.primary_key.columns]
+    if primary_key == []:
+        raise Exception(f"The table {table.name} has no primary key.")
+
+    staged_dates = select(stage.c[date_column]).distinct()
+    key_match = and_(*[table.c[key] == stage.c[key] for key in primary_key])
+    columns = [col.name for col in table.columns]
+    
+    with report.stage("merge_apply", table=table.name, rows_in=len(df)):
+        #SQL Server can update matching rows in place using MERGE
+        if con.dialect.name == "mssql":
+            #Remove rows for the staged dates that are not in the new data
+            con.execute(
+                delete(table).where(
+                    table.c[date_column].in_(staged_dates),
+                    ~exists().where(key_match)
+                )
+            )
+
+            preparer = con.dialect.identifier_preparer
+            on_clause = " AND ".join(
+                [f"tgt.{preparer.quote(key)} = src.{preparer.quote(key)}" 
+                 for key in primary_key])
+            update_clause = ", ".join(
+                [f"tgt.{preparer.quote(col)} = src.{preparer.quote(col)}" 
+                 for col in columns if col not in primary_key])
+            col_list = ", ".join([preparer.quote(col) for col in columns])
+            src_list = ", ".join([f"src.{preparer.quote(col)}" 
+                                  for col in columns])
+
+            con.exec_driver_sql(
+                f"MERGE {preparer.format_table(table)} WITH (HOLDLOCK) AS tgt "
+                f"USING {preparer.quote(stage.name)} AS src ON {on_clause} "
+                f"WHEN MATCHED THEN UPDATE SET {update_clause} "
+                f"WHEN NOT MATCHED BY TARGET THEN INSERT ({col_list}) "
+                f"VALUES ({src_list});"
+            )
+
+        #Other databases replace the staged dates then insert from the stage
+        else:
+            con.execute(
+                delete(table).where(table.c[date_column].in_(staged_dates)))
+            con.execute(
+                insert(table).from_select(
+                    columns, select(*[stage.c[col] for col in columns])))
+
+    con.exec_driver_sql(
+        f"DROP TABLE {con.dialect.identifier_preparer.quote(stage.name)}")
+
+    return len(df)
+
+#Check whether a column holds numbers
+#(Float is not a subclass of Numeric in newer versions of SQLAlchemy)
+def is_number_type(col_type):
+    return isinstance(col_type, (types.Numeric, types.Float, types.Integer))
+
+#Build a frame of comparable values for hashing the primary keys
+#Values read back from the database and values from a processed frame are
+#converted to the same types so identical keys always hash the same
+def normalise_rows(df, table, columns):
+    normalised = {}
+
+    for col in columns:
+        series = df[col].reset_index(drop=True)
+        col_type = table.c[col].type
+
+        if isinstance(col_type, (types.Date, types.DateTime)):
+            series = pd.to_datetime(series).astype("datetime64[ns]")
+        elif is_number_type(col_type):
+            series = pd.to_numeric(series).astype("float64")
+        else:
+            series = series.astype(object).where(series.notna(), None)
+
+        normalised[col] = series
+
+    return pd.DataFrame(normalised)
+
+#Hash the rows of a frame (returns an array of uint64 hashes)
+def hash_rows(df):
+    return pd.util.hash_pandas_object(df, index=False).to_numpy()
+
+#Row hashes for the delta load are calculated by the database for the rows
+#already loaded and in Python for the new rows, so each value is converted to
+#the same text on both sides and the text of the row is hashed with MD5:
+#dates as YYYY-MM-DD (and times as HH:MM:SS), numbers rounded to 
+#HASH_DECIMALS decimal places, text without trailing spaces (CHAR columns are
+#padded) and missing values as HASH_NULL. The values are joined with 
+#HASH_SEPARATOR and hashed as UTF-16 (the NVARCHAR encoding of SQL Server).
+HASH_DECIMALS = 6
+HASH_NULL = "~"
+HASH_SEPARATOR = "|"
+
+#Name of the row hash function registered with SQLite
+SQLITE_HASH_FUNCTION = "wf_row_hash"
+
+#Hash the text of a row
+def hash_text(row_text):
+    return hashlib.md5(row_text.encode("utf-16-le")).digest()
+
+
+#Convert a column of a frame to the text used in the row hash
+def hash_value_text(series, col_type):
+    series = series.reset_index(drop=True)
+
+    if isinstance(col_type, types.DateTime):
+        values = pd.to_datetime(series).dt.strftime("%Y-%m-%d %H:%M:%S")
+    elif isinstance(col_type, types.Date):
+        values = pd.to_datetime(series).dt.strftime("%Y-%m-%d")
+    elif is_number_type(col_type):
+        #Rounded half away from zero as the databases do
+        scaled = pd.to_numeric(series).astype("float64").to_numpy() * (
+            10 ** HASH_DECIMALS)
+        rounded = np.where(scaled < 0, np.ceil(scaled - 0.5), 
+                           np.floor(scaled + 0.5))
+        values = pd.Series(rounded).astype("Int64").astype(str)
+        values = values.where(~np.isnan(rounded), None)
+    else:
+        values = series.astype(str).str.rstrip().where(series.notna(), None)
+
+    return values.where(values.notna(), HASH_NULL)
+
+#Hash the rows of a frame the same way as the database (see row_hash_sql)
+#Returns an array of MD5 digests
+def hash_frame_rows(df, table, columns):
+    texts = [hash_value_text(df[col], table.c[col].type) for col in columns]
+    row_texts = texts[0].str.cat(texts[1:], sep=HASH_SEPARATOR)
+    return np.array([hash_text(row_text) for row_text in row_texts], 
+                    dtype=object)
+
+#Return the SQL converting a column to the text used in the row hash
+def hash_value_sql(col, col_type, dialect):
+    col = dialect.identifier_preparer.quote(col)
+    scale = 10 ** HASH_DECIMALS
+
+    if dialect.name == "mssql":
+        if isinstance(col_type, types.DateTime):
+            value = f"CONVERT(CHAR(19), {col}, 120)"
+        elif isinstance(col_type, types.Date):
+            value = f"CONVERT(CHAR(10), {col}, 23)"
+        elif is_number_type(col_type):
+            value = (f"CONVERT(VARCHAR(20), "
+                     f"CAST(ROUND({col} * {scale}, 0) AS BIGINT))")
+        else:
+            value = f"RTRIM({col})"
+        return f"COALESCE({value}, N'{HASH_NULL}')"
+
+    if isinstance(col_type, types.DateTime):
+        value = f"strftime('%Y-%m-%d %H:%M:%S', {col})"
+    elif isinstance(col_type, types.Date):
+        value = f"date({col})"
+    elif is_number_type(col_type):
+        value = f"CAST(CAST(ROUND({col} * {scale}) AS INTEGER) AS TEXT)"
+    else:
+        value = f"rtrim({col})"
+    return f"COALESCE({value}, '{HASH_NULL}')"
+
+#Return the SQL for the hash of each row of a table (see hash_frame_rows)
+def row_hash_sql(table, columns, dialect):
+    values = [hash_value_sql(col, table.c[col].type, dialect) 
+              for col in columns]
+
+    if dialect.name == "mssql":
+        row_text = f", N'{HASH_SEPARATOR}', ".join(values)
+        return (f"HASHBYTES('MD5', "
+                f"CAST(CONCAT({row_text}, N'') AS NVARCHAR(4000)))")
+    if dialect.name == "sqlite":
+        return (f"{SQLITE_HASH_FUNCTION}(" + 
+                f" || '{HASH_SEPARATOR}' || ".join(values) + ")")
+
+    raise Exception((f"The delta load mode does not support "
+                     f"{dialect.name} databases."))
+
+#Apply only the differences between a frame and the destination rows for the
+#same dates. Rows are compared using a hash of every column (except the
+#ignored columns i.e. the upload timestamp) so only new, changed and removed
+#rows are written and unchanged rows are left alone. Only the keys and row
+#hashes of the existing rows are read from the database.
+#Returns a dict of the row counts and the dates that changed.
+#The caller is responsible for committing the transaction.
+def delta_upsert(con, table, df, date_column="date_data", 
+                 ignore_columns=("date_upload",), method="executemany",
+                 batch_size=1000, staging_dir="./data/staging/", 
+                 con_debug=True):
+
+    primary_key = [col.name for col in table.primary_key.columns]
+    if primary_key == []:
+        raise Exception(f"The table {table.name} has no primary key.")
+    columns = [col.name for col in table.columns 
+               if col.name not in ignore_columns and col.name in df.columns]
+
+    with report.stage("delta_diff", table=table.name, 
+                      rows_in=len(df)) as metrics:
+        #Hash the keys and full rows of the new data
+        df_new_keys = normalise_rows(df, table, primary_key)
+        new_keys = hash_rows(df_new_keys)
+        if pd.Index(new_keys).has_duplicates:
+            raise Exception((f"The data for {table.name} contains duplicate "
+                             "primary keys so it cannot be delta loaded."))
+        new_rows = hash_frame_rows(df, table, columns)
+
+        #Read the keys and row hashes (calculated by the database) of the 
+        #existing rows for the dates in the data in one query
+        if con.dialect.name == "sqlite":
+            con.connection.driver_connection.create_function(
+                SQLITE_HASH_FUNCTION, 1, hash_text, deterministic=True)
+        dates = [pd.Timestamp(date).date() 
+                 for date in df[date_column].dropna().unique()]
+        existing = con.execute(
+            select(*[table.c[key] for key in primary_key],
+                   literal_column(row_hash_sql(table, columns, con.dialect))
+                   ).where(table.c[date_column].in_(dates))).fetchall()
+        df_existing = pd.DataFrame(existing, columns=primary_key + 
+                                   ["row_hash"])
+        metrics["rows_existing"] = len(df_existing)
+
+        old_keys = hash_rows(normalise_rows(df_existing, table, primary_key))
+        old_rows = df_existing["row_hash"].to_numpy(dtype=object)
+
+        #Match each new row to the existing row with the same key
+        matches = pd.Index(old_keys).get_indexer(new_keys)
+        is_new = matches < 0
+        is_changed = np.zeros(len(df), dtype=bool)
+        is_changed[~is_new] = [
+            bytes(old_hash) != new_hash for old_hash, new_hash in 
+            zip(old_rows[matches[~is_new]], new_rows[~is_new])]
+        is_removed = pd.Index(new_keys).get_indexer(old_keys) < 0
+
+        #The changed rows are deleted then inserted with the new rows
+        is_replaced = np.zeros(len(df_existing), dtype=bool)
+        is_replaced[matches[is_changed]] = True
+
+        counts = {
+            "new": int(is_new.sum()),
+            "changed": int(is_changed.sum()),
+            "removed": int(is_removed.sum()),
+            "unchanged": int(len(df) - is_new.sum() - is_changed.sum())
+        }
+        metrics.update(counts)
+
+    #Delete the changed and removed rows by their key
+    df_delete = df_existing.loc[is_removed | is_replaced, primary_key]
+    if len(df_delete) > 0:
+        with report.stage("delta_delete", table=table.name, 
+                          rows_in=len(df_delete)):
+            con.execute(
+                delete(table).where(and_(
+                    *[table.c[key] == bindparam("key_" + key) 
+                      for key in primary_key])),
+                [{"key_" + key: value for key, value in zip(primary_key, row)}
+                 for row in df_delete.itertuples(index=False)])
+
+    #Insert the new and changed rows
+    df_insert = df[is_new | is_changed]
+    bulk_insert(con, table, df_insert, method, batch_size, staging_dir, 
+                con_debug)
+
+    for name, count in counts.items():
+        report.count(f"rows_{name}", count)
+
+    if con_debug:
+        print(f"Delta load into {table.name}: {counts['new']} new, "
+              f"{counts['changed']} changed, {counts['removed']} removed and "
+              f"{counts['unchanged']} unchanged rows")
+
+    #Dates with any new, changed or removed rows
+    changed_dates = pd.concat([
+        df_insert[date_column],
+        pd.to_datetime(df_existing.loc[is_removed, date_column]).astype(
+            df[date_column].dtype)]).unique()
+    counts["dates"] = changed_dates
+
+    return counts
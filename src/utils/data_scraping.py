@@ -1,10 +1,19 @@
 import os
+import re
+import time
+import json
+import hashlib
+import threading
 import requests
 from bs4 import BeautifulSoup
-import pandas as pd
-from io import BytesIO
-from zipfile import ZipFile
 from datetime import datetime
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from utils.data_ingest import is_zip_file
+from utils.instrumentation import report
 
 #To explain the terminalogy in this script:
 #The NHSD website is made up of "publications" which contain "pages" 
@@ -14,19 +23,104 @@ from datetime import datetime
 #"File Links" are the url links on pages that contain the data files
 #"Files" refers to the target data itself
 
+#All requests share one session so connections are pooled and reused.
+#Pages and files are fetched concurrently using a thread pool.
+
+#Files already downloaded are recorded in a manifest (with their ETag,
+#Last-Modified and content hash) so later scrapes can send conditional
+#requests and skip files that have not changed. Page listings are cached
+#locally for a configurable number of seconds.
+
+#Files are downloaded into a .part file and resumed with range requests if
+#the connection drops, then checked and renamed into place so a partly
+#downloaded file is never picked up by the load.
+#ZIP archives are saved as they are downloaded (with a .zip extension even
+#if the link does not have one) and their CSV members are read straight from
+#the archive when the data is loaded (see utils/data_ingest.py).
+
+#Range (backfill) scrapes record each page once all of its files are
+#downloaded in a checkpoint file so an interrupted backfill can be resumed.
+
+#Size of the blocks used when streaming a file to disk
+#(a dropped connection loses the part of the block already received so this
+#is also how far a resumed download can fall back)
+CHUNK_SIZE = 64 * 1024
+
+#Lock used when updating the manifest from the download threads
+manifest_lock = threading.Lock()
+
+#Create a HTTP session with a connection pool and retry with backoff
+def create_session(max_workers=4, retries=3, backoff=0.5):
+    session = requests.Session()
+
+    retry = Retry(total=retries,
+                  backoff_factor=backoff,
+                  status_forcelist=[429, 500, 502, 503, 504],
+                  allowed_methods=["GET", "HEAD"])
+    adapter = HTTPAdapter(pool_connections=max_workers, 
+                          pool_maxsize=max_workers,
+                          max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    return session
+
+#Load the download manifest (a dict of file entries keyed on url)
+def load_manifest(manifest_path):
+    if manifest_path and os.path.isfile(manifest_path):
+        with open(manifest_path) as file:
+            return json.load(file)
+    return {}
+
+#Save the download manifest
+#(written to a temporary file first so the manifest is never left half written)
+def save_manifest(manifest, manifest_path):
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    with manifest_lock:
+        with open(manifest_path + ".tmp", "w") as file:
+            json.dump(manifest, file, indent=2)
+        os.replace(manifest_path + ".tmp", manifest_path)
+
+#Return the html for a url, using the local page cache if it is fresh enough
+def get_html(full_url, session, timeout=60, cache_dir=None, cache_ttl=0):
+    
+    #Check the cache for a recent copy of the page
+    if cache_dir and cache_ttl > 0:
+        cache_key = hashlib.sha256(full_url.encode()).hexdigest()
+        cache_path = os.path.join(cache_dir, cache_key + ".html")
+        if (os.path.isfile(cache_path) and 
+            time.time() - os.path.getmtime(cache_path) < cache_ttl):
+            report.count("pages_cached")
+            with open(cache_path, encoding="utf-8") as file:
+                return file.read()
+
+    #Make a request for the page
+    res = session.get(full_url, timeout=timeout)
+    res.raise_for_status()
+    report.count("pages_requested")
+
+    #Store the page in the cache
+    if cache_dir and cache_ttl > 0:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(cache_path, "w", encoding="utf-8") as file:
+            file.write(res.text)
+
+    return res.text
+
 #Get the n most recent pages from the specified nhsd page
 def get_last_n_pages(n, nhsd_publication,
                      url="https://digital.nhs.uk", 
-                     section="/data-and-information/publications/statistical/"):
+                     section="/data-and-information/publications/statistical/",
+                     session=None, timeout=60, cache_dir=None, cache_ttl=0):
     pages = []
+    session = session or requests
 
     #Get the full url to the publication
     url_full = url + section + nhsd_publication + "/"
 
     #Make a request to get all pages in the publication
-    res = requests.get(url_full)
-    res.raise_for_status()
-    soup = BeautifulSoup(res.text, 'html.parser')
+    html = get_html(url_full, session, timeout, cache_dir, cache_ttl)
+    soup = BeautifulSoup(html, 'html.parser')
 
     #Get the latest page via the HTML div id
     ls_div = soup.find(id="latest-statistics")
@@ -47,14 +141,117 @@ def get_last_n_pages(n, nhsd_publication,
 
     return pages
 
+#Get the pages released between the start and end month (inclusive)
+#start and end are given as "YYYY-MM" and are matched against the release
+#month in the page url (i.e. .../july-2024)
+def get_pages_in_range(start, end, nhsd_publication,
+                       url="https://digital.nhs.uk", 
+                       section="/data-and-information/publications/statistical/",
+                       session=None, timeout=60, cache_dir=None, 
+                       cache_ttl=0):
+    session = session or requests
+
+    start_period = parse_month(start)
+    end_period = parse_month(end)
+    if start_period > end_period:
+        raise Exception(
+            f"The scrape range start {start} is after the end {end}.")
+
+    #Get the full url to the publication
+    url_full = url + section + nhsd_publication + "/"
+
+    #Make a request to get all pages in the publication
+    html = get_html(url_full, session, timeout, cache_dir, cache_ttl)
+    soup = BeautifulSoup(html, 'html.parser')
+
+    #The latest page and every past page in the publication
+    page_links = [soup.find(id="latest-statistics").a]
+    pp_div = soup.find(id="past-publications")
+    if pp_div:
+        page_links += pp_div.find_all("a", attrs={"class": "cta__button"})
+
+    #Keep the pages released within the range
+    pages = []
+    periods_found = set()
+    for a_tag in page_links:
+        page = a_tag.get("href")
+        period = get_page_period(page)
+        if period is None:
+            print(f"Warning: The release month of {page} could not be found.")
+        elif start_period <= period <= end_period and page not in pages:
+            pages.append(page)
+            periods_found.add(period)
+
+    #Warn about any months in the range without a release
+    for period in month_range(start_period, end_period):
+        if period not in periods_found:
+            print(f"Warning: No release was found for {period:%B %Y}.")
+
+    return pages
+
+#Convert a "YYYY-MM" string into a datetime for the start of the month
+def parse_month(month):
+    try:
+        return datetime.strptime(month, "%Y-%m")
+    except ValueError:
+        raise Exception(f"{month} is not a valid month (expected YYYY-MM).")
+
+#Return every month between the start and end month (inclusive)
+def month_range(start_period, end_period):
+    periods = []
+    year, month = start_period.year, start_period.month
+    while (year, month) <= (end_period.year, end_period.month):
+        periods.append(datetime(year, month, 1))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return periods
+
+#Get the release month from a page url (i.e. .../july-2024 is July 2024)
+def get_page_period(page):
+    slug = page.rstrip("/").split("/")[-1].lower()
+    match = re.search(r"([a-z]+)-(\d{4})$", slug)
+    if not match:
+        return None
+
+    #Month names are usually in full but allow for abbreviations
+    for month_format in ["%B %Y", "%b %Y"]:
+        try:
+            return datetime.strptime(" ".join(match.groups()), month_format)
+        except ValueError:
+            continue
+    return None
+
+#Load the scrape checkpoint for a job
+#A checkpoint left by a different job is ignored
+def load_checkpoint(checkpoint_path, job):
+    if checkpoint_path and os.path.isfile(checkpoint_path):
+        with open(checkpoint_path) as file:
+            checkpoint = json.load(file)
+        if checkpoint.get("job") == job:
+            return checkpoint
+    return {"job": job, "pages": []}
+
+#Save the scrape checkpoint
+def save_checkpoint(checkpoint, checkpoint_path):
+    os.makedirs(os.path.dirname(checkpoint_path), exist_ok=True)
+    with open(checkpoint_path + ".tmp", "w") as file:
+        json.dump(checkpoint, file, indent=2)
+    os.replace(checkpoint_path + ".tmp", checkpoint_path)
+
+#Remove the scrape checkpoint once a job has finished
+def clear_checkpoint(checkpoint_path):
+    if checkpoint_path and os.path.isfile(checkpoint_path):
+        os.remove(checkpoint_path)
+
 #For a given page, return a list of all files capturing the file id and period
-def get_file_links_from_page(page, url="https://digital.nhs.uk"):
+def get_file_links_from_page(page, url="https://digital.nhs.uk",
+                             session=None, timeout=60, cache_dir=None, 
+                             cache_ttl=0):
+    session = session or requests
 
     #Make a request to the full url
     full_url = url + page
-    res = requests.get(full_url)
-    res.raise_for_status()
-    soup = BeautifulSoup(res.text, 'html.parser')
+    html = get_html(full_url, session, timeout, cache_dir, cache_ttl)
+    soup = BeautifulSoup(html, 'html.parser')
 
     #Split by this div id to isolate the file links
     file_div = soup.find(id="resources")
@@ -87,8 +284,16 @@ def get_file_links_from_page(page, url="https://digital.nhs.uk"):
                 
     return relevant_files
 
-#Download data files for a given file_id and file_links
-def download_file_from_id(file_links, file_id):
+#Download the data file for a given file_id streaming it straight to disk
+#If the file is in the manifest a conditional request is made so unchanged
+#files are not downloaded again.
+#The file is written to a .part file first. If the connection drops the
+#download resumes from the last byte received using a range request, and the
+#file is only moved into the destination directory once its size (and MD5
+#hash when the server's ETag is one) has been checked.
+def download_file_from_id(file_links, file_id, dest_dir, session=None, 
+                          timeout=60, retries=3, backoff=0.5, manifest=None):
+    session = session or requests
 
     #Make a request for the file
     try:
@@ -96,57 +301,293 @@ def download_file_from_id(file_links, file_id):
     except:
         print(f"'{file_id}' could not be found for this publication.")
         return 0
-    res = requests.get(target_url)
+    
+    target_dest = get_file_dest(file_links, file_id, dest_dir)
+    part_dest = target_dest + ".part"
 
-    #Check if the request was successful
-    if res.status_code == 200:
-        return res.content
-    else:
-        print(f"Failed to download file with the following url:\n{target_url}.",
-              f"\nStatus code: {res.status_code}")
+    #Build the conditional request headers from the manifest
+    headers = {}
+    previous = manifest.get(target_url) if manifest is not None else None
+    if previous:
+        if previous.get("etag"):
+            headers["If-None-Match"] = previous["etag"]
+        if previous.get("last_modified"):
+            headers["If-Modified-Since"] = previous["last_modified"]
+
+    #Discard any partial file left by an interrupted run
+    remove_file(part_dest)
+    download = new_download()
+
+    #Retry with backoff if the connection drops while streaming
+    #(a dropped connection after some of the file was saved resumes without
+    #using up the retries so large files can resume any number of times)
+    attempt = 0
+    while True:
+        resume_size = download["size"]
+        try:
+            #Resume from the end of the partial file (only if the file on 
+            #the server has not changed, otherwise it is sent in full)
+            if download["size"] > 0:
+                request_headers = {"Range": f"bytes={download['size']}-"}
+                if download["validator"]:
+                    request_headers["If-Range"] = download["validator"]
+            else:
+                request_headers = headers
+
+            with session.get(target_url, stream=True, timeout=timeout,
+                             headers=request_headers) as res:
+
+                #The file has not changed since it was last downloaded
+                if res.status_code == 304:
+                    print(f"'{file_id}' is unchanged and was not downloaded.")
+                    report.count("files_unchanged")
+                    return 0
+
+                #Check if the request was successful
+                if res.status_code not in (200, 206):
+                    print(("Failed to download file with the following url:"
+                           f"\n{target_url}.\nStatus code: {res.status_code}"))
+                    remove_file(part_dest)
+                    return 0
+
+                if download["size"] > 0:
+                    report.count("downloads_resumed")
+
+                with report.stage("download", file=file_id, 
+                                  resumed=download["size"] > 0) as metrics:
+                    save_part(res, part_dest, download)
+                    verify_download(download)
+                    metrics["bytes"] = download["size"]
+                break
+
+        except (requests.ConnectionError, requests.Timeout, 
+                requests.exceptions.ChunkedEncodingError, 
+                IncompleteDownload) as e:
+            #A file that fails the checks is downloaded again from the start
+            if isinstance(e, IncompleteDownload):
+                remove_file(part_dest)
+                download = new_download()
+            elif download["size"] > resume_size:
+                attempt = 0
+            if attempt == retries:
+                remove_file(part_dest)
+                raise e
+            report.count("download_retries")
+            time.sleep(backoff * (2 ** attempt))
+            attempt += 1
+
+    file_hash = download["sha256"].hexdigest()
+
+    #The server ignored the conditional request but the content is the same
+    if previous and previous.get("sha256") == file_hash:
+        remove_file(part_dest)
+        print(f"'{file_id}' is unchanged and was not kept.")
+        report.count("files_unchanged")
         return 0
 
-#Save the request content as a file
-def save_file(content, page_links, file_id, dest_dir):
+    #Move the complete file into place (ZIP content is given a .zip extension
+    #whatever the extension in the url)
+    if is_zip_file(part_dest):
+        target_dest = os.path.splitext(target_dest)[0] + ".zip"
+        report.count("zip_files_downloaded")
+    os.replace(part_dest, target_dest)
+
+    report.count("files_downloaded")
+
+    #Record the download in the manifest
+    if manifest is not None:
+        with manifest_lock:
+            manifest[target_url] = {
+                "file_id": file_id,
+                "period": file_links[file_id].get("period"),
+                "etag": download["headers"].get("ETag"),
+                "last_modified": download["headers"].get("Last-Modified"),
+                "sha256": file_hash,
+                "downloaded": datetime.now().isoformat(timespec="seconds")
+            }
+
+    return target_dest
+
+#Get the destination filename for a given file_id
+def get_file_dest(page_links, file_id, dest_dir):
     target_link = page_links[file_id]
     file_period = target_link["period"]
     file_ext = target_link["ext"]
 
     #Build the full destination filename including the path
-    target_dest = dest_dir + file_id + " -" + file_period + "." + file_ext
-    
-    #Save the content as a file
-    with open(target_dest, "wb") as file:
-        file.write(content)
+    return dest_dir + file_id + " -" + file_period + "." + file_ext
+
+#Raised when a downloaded file does not match its expected size or hash
+class IncompleteDownload(Exception):
+    pass
+
+#Remove a file if it exists
+def remove_file(filepath):
+    if os.path.isfile(filepath):
+        os.remove(filepath)
+
+#The progress of a download (kept between attempts so it can be resumed)
+def new_download():
+    return {
+        "size": 0,
+        "total": None,
+        "validator": None,
+        "headers": None,
+        "sha256": hashlib.sha256(),
+        "md5": hashlib.md5()
+    }
+
+#Stream the response content into the partial file
+#A 206 (partial content) response is appended to the partial file, any other
+#response replaces it
+def save_part(res, part_dest, download):
+    content_range = res.headers.get("Content-Range", "")
+    match = re.match(r"bytes (\d+)-\d+/(\d+)", content_range)
+
+    if res.status_code == 206:
+        #The content must continue from the end of the partial file
+        if not match or int(match.group(1)) != download["size"]:
+            raise IncompleteDownload(("The server did not resume the "
+                                      "download from the expected byte."))
+        download["total"] = int(match.group(2))
+    else:
+        download.update(new_download())
+        download["headers"] = res.headers
+
+        #The size can only be checked if the content is not encoded
+        if (res.headers.get("Content-Length") and 
+            not res.headers.get("Content-Encoding")):
+            download["total"] = int(res.headers["Content-Length"])
+
+        #Only resume if the server can confirm the file has not changed
+        etag = res.headers.get("ETag")
+        if etag and not etag.startswith("W/"):
+            download["validator"] = etag
+        else:
+            download["validator"] = res.headers.get("Last-Modified")
+
+    with open(part_dest, "ab" if download["size"] > 0 else "wb") as file:
+        for chunk in res.iter_content(chunk_size=CHUNK_SIZE):
+            file.write(chunk)
+            download["size"] += len(chunk)
+            download["sha256"].update(chunk)
+            download["md5"].update(chunk)
+            report.count("bytes_downloaded", len(chunk))
+
+#Check a finished download has the expected size and hash
+#(the ETag is only compared when it is a plain MD5 hash, as it is for files 
+#served from S3)
+def verify_download(download):
+    if download["total"] is not None and download["size"] != download["total"]:
+        raise IncompleteDownload((f"Only {download['size']} of "
+                                  f"{download['total']} bytes were received."))
+
+    etag = (download["headers"].get("ETag") or "").strip('"')
+    if (re.fullmatch(r"[0-9a-f]{32}", etag) and 
+        download["md5"].hexdigest() != etag):
+        raise IncompleteDownload(("The downloaded file does not match the "
+                                  "hash given by the server."))
 
 #Main function that handles the data scrapping based on passed parameters
 def data_scrape(publication_name, target_files, 
-                dest_dir="./data/", mode="latest", mode_n=1, con_debug=True):
+                dest_dir="./data/", mode="latest", mode_n=1, con_debug=True,
+                url="https://digital.nhs.uk", max_workers=4, retries=3, 
+                backoff=0.5, timeout=60, manifest_path=None, cache_dir=None,
+                cache_ttl=0, mode_range=None, checkpoint_path=None):
     #Printing for more user friendly output
     if con_debug:
         print("Data scraping start...")
+
+    #Share one pooled session across all requests
+    session = create_session(max_workers, retries, backoff)
+
+    #Load the record of previously downloaded files
+    manifest = load_manifest(manifest_path) if manifest_path else None
+    checkpoint = None
     
     ##Get the pages using the specified data scraping mode
 
     #Latest n mode
     if mode == "latest":
-        pages = get_last_n_pages(mode_n, publication_name)
+        pages = get_last_n_pages(mode_n, publication_name, url=url,
+                                 session=session, timeout=timeout,
+                                 cache_dir=cache_dir, cache_ttl=cache_ttl)
+    #Range mode (start and end month)
+    elif mode == "range":
+        pages = get_pages_in_range(mode_range[0], mode_range[1], 
+                                   publication_name, url=url, 
+                                   session=session, timeout=timeout, 
+                                   cache_dir=cache_dir, cache_ttl=cache_ttl)
+
+        #Skip the pages finished before the backfill was interrupted
+        if checkpoint_path:
+            checkpoint = load_checkpoint(
+                checkpoint_path, f"{publication_name} {mode_range[0]} "
+                                 f"{mode_range[1]}")
+            if checkpoint["pages"] and con_debug:
+                print(f"Resuming the backfill ({len(checkpoint['pages'])} "
+                      f"of {len(pages)} pages already downloaded).")
+            pages = [page for page in pages 
+                     if page not in checkpoint["pages"]]
     #Mode not found
     else:
         raise Exception(f"The data scraping mode {mode} is not supported.")
 
-    #Handle each returned page
-    for page in pages:
-        if con_debug:
-            print(page)
+    downloaded = []
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+
+        #Get the file links for every page concurrently
+        page_futures = {
+            pool.submit(get_file_links_from_page, page, url, session, timeout,
+                        cache_dir, cache_ttl):
+            page for page in pages}
         
-        #Get file links
-        res_file_links = get_file_links_from_page(page)
-
-        #For each target file desired
-        for target in target_files:
-            #Download the content
-            res_file = download_file_from_id(res_file_links, target)
-            #Save the content
+        #Queue the downloads for each page as soon as its links are known
+        file_futures = {}
+        for future in as_completed(page_futures):
+            page = page_futures[future]
+            if con_debug:
+                print(page)
+            res_file_links = future.result()
+
+            for target in target_files:
+                file_futures[
+                    pool.submit(download_file_from_id, res_file_links, target,
+                                dest_dir, session, timeout, retries, backoff,
+                                manifest)] = page
+
+        #Wait for all downloads to finish
+        #A failed download does not stop the other pages being checkpointed
+        #(the first error is raised once the other downloads have finished)
+        files_remaining = Counter(file_futures.values())
+        failed_pages = set()
+        download_error = None
+        for future in as_completed(file_futures):
+            page = file_futures[future]
+            try:
+                res_file = future.result()
+            except Exception as e:
+                failed_pages.add(page)
+                download_error = download_error or e
+                continue
             if res_file:
-                save_file(res_file, res_file_links, target, "./data/current/")
\ No newline at end of file
+                downloaded.append(res_file)
+
+            #Checkpoint each page once all of its files are downloaded
+            files_remaining[page] -= 1
+            if (checkpoint is not None and files_remaining[page] == 0 and 
+                page not in failed_pages):
+                checkpoint["pages"].append(page)
+                if manifest_path:
+                    save_manifest(manifest, manifest_path)
+                save_checkpoint(checkpoint, checkpoint_path)
+
+    session.close()
+
+    if manifest_path:
+        save_manifest(manifest, manifest_path)
+
+    if download_error is not None:
+        raise download_error
+
+    return downloaded
\ No newline at end of file
@@ -0,0 +1,158 @@
+import hashlib
+import numpy as np
+import pandas as pd
+
+from datetime import datetime
+
+from utils.data_ingest import get_file_hash, load_column_map
+
+#This script transforms the London rows of the NHSD source files into the
+#format of the warehouse tables.
+#The processing avoids copying the whole frame and keeps repeated text columns
+#as categoricals so string operations only run once per distinct value.
+
+#Columns with few distinct values that are stored as categoricals
+CATEGORY_COLUMNS = ["org_code", "org_name", "staffgroup", "reason_full"]
+
+#Version of the transform used to key the processed cache
+#Increment this whenever process_benchmarking_data changes its output
+TRANSFORM_VERSION = 1
+
+#The NHSD Data files change over time
+def process_benchmarking_data(df_in, file_type, ics_lookup, settings):
+
+    #Map column names (and drop unused columns)
+    ##Load the map file
+    df_map = load_column_map(settings["map_column"])
+    ##Apply the map on the column names (this does not modify df_in)
+    df = df_in.rename(columns=df_map.set_index("source_name")["output_name"])
+    
+    ##Remove unused columns (columns not specified in the map file)
+    df = df[df.columns.intersection(df_map["output_name"].values)]
+
+    #Filter to London only (source files are normally already filtered)
+    region_code = settings["region_code_london"]
+    london = df["region_code"] == region_code
+    if not london.all():
+        df = df[london]
+
+    #Drop the region_code column
+    df = df.drop(columns="region_code")
+
+    #Store the repeated text columns as categoricals
+    for col in df.columns.intersection(CATEGORY_COLUMNS):
+        df[col] = df[col].astype("category")
+
+    #By Reason specific processing
+    if file_type == "ByReason":
+        #Split reason_full column into code and description
+        df["reason_code"] = map_categories(df["reason_full"], 
+                                           lambda x: x[0:3])
+        df["reason_desc"] = map_categories(df["reason_full"], 
+                                           lambda x: x[4:])
+        df = df.drop(columns="reason_full")
+
+    #Add ics columns using the precomputed ICS mapping
+    #(see build_ics_mapping, this already includes the RNOH and CNWL fixes)
+    df = join_categorical(df, "org_code", ics_lookup)
+
+    #Add a current timestamp to the data
+    df["date_upload"] = datetime.today()
+
+    #Convert existing date column to date object
+    df["date_data"] = parse_dates(df["date_data"], settings["date_format"])
+    
+    return df
+
+#Look up each code in an array of values (codes of -1 i.e. missing values get
+#the fill value). Only the valid codes are looked up so an empty array of 
+#values (i.e. a column that is all missing) is handled.
+def take_codes(values, codes, fill=-1):
+    valid = codes >= 0
+    result = np.full(len(codes), fill, 
+                     dtype=np.result_type(values, np.asarray(fill)))
+    result[valid] = values[codes[valid]]
+    return result
+
+#Apply a function to each distinct value of a categorical column
+def map_categories(series, func):
+    codes = series.cat.codes.to_numpy()
+
+    #Map the categories and merge any that now share a value
+    new_codes, new_categories = pd.factorize(series.cat.categories.map(func))
+    
+    #Missing values keep a code of -1
+    codes = take_codes(new_codes, codes)
+
+    return pd.Categorical.from_codes(codes, categories=new_categories)
+
+#Join columns from a mapping (indexed on key) onto a categorical key column
+def join_categorical(df, key, mapping):
+    codes = df[key].cat.codes.to_numpy()
+
+    #Find the position of each distinct key in the mapping
+    key_positions = mapping.index.get_indexer(df[key].cat.categories)
+    positions = take_codes(key_positions, codes)
+
+    for col in mapping.columns:
+        map_col = mapping[col]
+        if not isinstance(map_col.dtype, pd.CategoricalDtype):
+            map_col = map_col.astype("category")
+        col_codes = map_col.cat.codes.to_numpy()
+        df[col] = pd.Categorical.from_codes(
+            take_codes(col_codes, positions),
+            categories=map_col.cat.categories)
+    
+    return df
+
+#Convert a column of date strings, parsing each distinct value only once
+def parse_dates(series, date_format):
+    values = series.astype("category")
+    categories = values.cat.categories
+
+    #Use the explicit format and fall back to inferring it (day first)
+    try:
+        dates = pd.to_datetime(categories, format=date_format)
+    except ValueError:
+        dates = pd.to_datetime(categories, dayfirst=True)
+
+    codes = values.cat.codes.to_numpy()
+    return pd.Series(take_codes(dates.to_numpy(), codes, 
+                                np.datetime64("NaT")), index=series.index)
+
+#Build the org_code to ICS mapping used by process_benchmarking_data
+#This is done once per run so each file only needs a single join
+def build_ics_mapping(df_lookup, settings):
+
+    #Fix issue with RNOH and CNWL ics_code
+    #In some NHSE datasets, RNOH is labelled as NWL and CNWL is labelled as NCL
+    #The overrides are set in the [codes.ics_override] section of config.toml
+    df_override = pd.DataFrame(
+        [[org_code, ics[0], ics[1]] 
+         for org_code, ics in settings["ics_override"].items()],
+        columns=["org_code", "ics_code", "ics_name"])
+
+    df_mapping = pd.concat(
+        [df_lookup[~df_lookup["org_code"].isin(df_override["org_code"])],
+         df_override], ignore_index=True)
+    
+    #Keep one row per organisation with categorical ICS columns
+    df_mapping = df_mapping.drop_duplicates("org_code").set_index("org_code")
+    df_mapping = df_mapping[["ics_code", "ics_name"]].astype("category")
+
+    return df_mapping
+
+#Get the processed cache key for a source file
+#The key covers everything the processed frame depends on: the source content,
+#the transform version, the column map, the ICS mapping and related settings.
+#It starts with the file hash and dataset so the older entries for the same
+#file can be found (see save_processed in processed_cache.py).
+def get_transform_key(file_hash, file_type, ics_lookup, settings):
+    key = hashlib.sha256()
+    for part in [file_hash, file_type, str(TRANSFORM_VERSION),
+                 get_file_hash(settings["map_column"]),
+                 settings["region_code_london"], settings["date_format"]]:
+        key.update(part.encode() + b"\0")
+    key.update(pd.util.hash_pandas_object(ics_lookup).to_numpy().tobytes())
+
+    return f"{file_hash}-{file_type}-{key.hexdigest()}"
@@ -0,0 +1,154 @@
+import cProfile
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+from contextlib import contextmanager
+from datetime import datetime
+
+#This script records how long each stage of a run takes so slow runs can be
+#diagnosed and performance can be trended across the monthly loads.
+#A single report object is shared by the whole run:
+#
+#   with report.stage("transform", file=filename) as metrics:
+#       ...
+#       metrics["rows_out"] = len(df)
+#
+#   report.count("bytes_downloaded", len(chunk))
+#
+#Peak memory is measured with tracemalloc when enabled. Stages that run at the
+#same time on different threads share the tracemalloc peak so their peak
+#memory figures are for the process as a whole.
+#The tracemalloc peak is reset at the start of each stage, so the peak seen so
+#far is first passed on to the stages that are still running (i.e. the
+#scrape stage around each download) so their peak is not lost.
+
+class RunReport:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = []
+        self.counters = {}
+        self.started = None
+        self.start_time = None
+        self.trace_memory = False
+        self.profiler = None
+        self.active_peaks = []
+
+    #Start recording a run
+    def start(self, trace_memory=False, profile=False):
+        self.stages = []
+        self.counters = {}
+        self.started = datetime.now()
+        self.start_time = time.perf_counter()
+
+        self.trace_memory = trace_memory
+        self.active_peaks = []
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+        if profile:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    #Record the time taken (and peak memory) for a stage of the run
+    #The caller can add extra metrics (i.e. rows_in, rows_out) to the dict
+    @contextmanager
+    def stage(self, name, **details):
+        metrics = dict(details)
+
+        #The highest peak of the stage from before any reset of the peak
+        stage_peak = [0]
+        tracing = self.trace_memory and tracemalloc.is_tracing()
+        if tracing:
+            with self.lock:
+                peak = tracemalloc.get_traced_memory()[1]
+                for active_peak in self.active_peaks:
+                    active_peak[0] = max(active_peak[0], peak)
+                tracemalloc.reset_peak()
+                self.active_peaks.append(stage_peak)
+
+        start = time.perf_counter()
+        try:
+            yield metrics
+        finally:
+            metrics["stage"] = name
+            metrics["seconds"] = round(time.perf_counter() - start, 4)
+            with self.lock:
+                if tracing and tracemalloc.is_tracing():
+                    peak = max(stage_peak[0], 
+                               tracemalloc.get_traced_memory()[1])
+                    metrics["peak_mb"] = round(peak / 1024 ** 2, 2)
+                if tracing:
+                    self.active_peaks = [active_peak for active_peak in 
+                                         self.active_peaks 
+                                         if active_peak is not stage_peak]
+                self.stages.append(metrics)
+
+    #Add to a run level counter (i.e. bytes downloaded)
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    #Return and clear the recorded stages and counters
+    #(Used to pass the measurements from a worker process back to the run)
+    def drain(self):
+        with self.lock:
+            stages, counters = self.stages, self.counters
+            self.stages, self.counters = [], {}
+        return stages, counters
+
+    #Add measurements recorded elsewhere (i.e. by a worker process)
+    def merge(self, stages, counters):
+        with self.lock:
+            self.stages.extend(stages)
+            for name, value in counters.items():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    #Summarise the stages by name
+    def summary(self):
+        totals = {}
+        for metrics in self.stages:
+            entry = totals.setdefault(metrics["stage"],
+                                      {"count": 0, "seconds": 0.0})
+            entry["count"] += 1
+            entry["seconds"] = round(entry["seconds"] + metrics["seconds"], 4)
+            if metrics.get("peak_mb") is not None:
+                entry["peak_mb"] = max(entry.get("peak_mb", 0),
+                                       metrics["peak_mb"])
+        return totals
+
+    #Write the report (and profile if enabled) to the given directory
+    def write(self, report_dir):
+        os.makedirs(report_dir, exist_ok=True)
+        run_id = self.started.strftime("%Y%m%d_%H%M%S")
+        report_path = os.path.join(report_dir, f"run_report_{run_id}.json")
+
+        report_data = {
+            "started": self.started.isoformat(timespec="seconds"),
+            "seconds": round(time.perf_counter() - self.start_time, 4),
+            "summary": self.summary(),
+            "counters": self.counters,
+            "stages": self.stages
+        }
+
+        if self.trace_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+        if self.profiler is not None:
+            self.profiler.disable()
+            profile_path = os.path.join(report_dir, 
+                                        f"run_profile_{run_id}.prof")
+            self.profiler.dump_stats(profile_path)
+            report_data["profile"] = profile_path
+            self.profiler = None
+
+        with open(report_path, "w") as file:
+            json.dump(report_data, file, indent=2, default=str)
+
+        return report_path
+
+#The report for the current run
+report = RunReport()
@@ -0,0 +1,64 @@
+import os
+import pandas as pd
+
+#pyarrow is optional, the cache falls back to pickle files without it
+try:
+    import pyarrow.feather as feather
+except ImportError:
+    feather = None
+
+#This script stores the processed (London only) frame for each source file
+#so reloads and rebuilds can skip parsing the national CSV files.
+#Entries are keyed on a hash of everything the processed frame depends on
+#(see get_transform_key in data_transform.py) so a changed source file, 
+#transform or lookup simply misses the cache rather than needing the cache
+#cleared. Keys are "<file hash>-<dataset>-<transform hash>" and saving an entry
+#removes the older entries for the same file (made by an older transform or 
+#lookup) so the cache holds at most one entry per source file and dataset.
+#Entries are stored as uncompressed Feather files (memory mapped when read)
+#when pyarrow is installed and as pickle files otherwise.
+
+#Get the path of a cache entry
+def get_cache_path(cache_dir, key):
+    extension = ".feather" if feather is not None else ".pkl"
+    return os.path.join(cache_dir, key + extension)
+
+#Load a processed frame from the cache (returns None if it is not cached)
+def load_processed(cache_dir, key):
+    cache_path = get_cache_path(cache_dir, key)
+    if not os.path.isfile(cache_path):
+        return None
+
+    if feather is not None:
+        return feather.read_table(cache_path, memory_map=True).to_pandas()
+    return pd.read_pickle(cache_path)
+
+#Save a processed frame to the cache
+def save_processed(df, cache_dir, key):
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_path = get_cache_path(cache_dir, key)
+
+    #Feather files can only store a default index
+    df = df.reset_index(drop=True)
+
+    #Write to a temporary file first so a partial entry is never read
+    if feather is not None:
+        feather.write_feather(df, cache_path + ".tmp",
+                              compression="uncompressed")
+    else:
+        df.to_pickle(cache_path + ".tmp")
+    os.replace(cache_path + ".tmp", cache_path)
+
+    prune_processed(cache_dir, key)
+
+#Remove the entries for the same source file and dataset as a key that were
+#made by an older transform or lookup (they can never be read again)
+def prune_processed(cache_dir, key):
+    source_key = key.rsplit("-", 1)[0] + "-"
+    for entry in os.listdir(cache_dir):
+        if entry.startswith(source_key) and entry.split(".")[0] != key:
+            try:
+                os.remove(os.path.join(cache_dir, entry))
+            except FileNotFoundError:
+                #Removed by another worker at the same time
+                pass
@@ -0,0 +1,181 @@
+import pandas as pd
+
+from datetime import datetime
+from sqlalchemy import and_, delete, select
+
+from utils.data_loading import bulk_insert
+from utils.instrumentation import report
+
+#This script maintains the pre-aggregated sickness rate tables (rollups) so
+#dashboards do not need to scan the fact tables.
+#Each rollup has a row per month, area (org or ICS) and breakdown with the
+#month's sums and rate plus the sums and rate for the 12 months to that month.
+#When a month is loaded only the rollup rows that depend on it (that month and
+#the following 11 months) are recomputed, from a window of the fact table
+#covering the 11 months either side.
+#
+#The denominator only includes rows where the numerator is known so
+#suppressed values do not lower the rate.
+
+#Length of the rolling window in months
+WINDOW_MONTHS = 12
+
+#Rollup definition for each dataset
+ROLLUPS = {
+    "Sickness": {
+        "keys": ["staffgroup"],
+        "attributes": [],
+        "numerator": "days_lost",
+        "denominator": "days_available"
+    },
+    "ByReason": {
+        "keys": ["reason_code", "staffgroup"],
+        "attributes": ["reason_desc"],
+        "numerator": "days_lost_reason",
+        "denominator": "days_available"
+    }
+}
+
+#Levels the rollups are aggregated to [code column, name column]
+LEVELS = {
+    "org": ["org_code", "org_name"],
+    "ics": ["ics_code", "ics_name"]
+}
+
+#Convert dates into a month number (months since year 0)
+def month_index(dates):
+    dates = pd.DatetimeIndex(pd.to_datetime(dates))
+    return (dates.year * 12 + dates.month - 1).to_numpy()
+
+#Get the first day of a month number
+def month_start(month):
+    return datetime(month // 12, month % 12 + 1, 1).date()
+
+#Get the last day of a month number
+def month_end(month):
+    return (pd.Timestamp(month_start(month)) + pd.offsets.MonthEnd(0)).date()
+
+#Aggregate the fact rows to each level for each month
+def aggregate_months(df_fact, dataset):
+    rollup = ROLLUPS[dataset]
+    numerator, denominator = rollup["numerator"], rollup["denominator"]
+
+    df = df_fact.assign(month=month_index(df_fact["date_data"]))
+    df[denominator] = df[denominator].where(df[numerator].notna())
+
+    frames = []
+    for level, (code_col, name_col) in LEVELS.items():
+        group_cols = ["month", code_col] + rollup["keys"]
+        first_cols = [col for col in dict.fromkeys(
+                          ["date_data", name_col, "ics_code", "ics_name"] + 
+                          rollup["attributes"])
+                      if col not in group_cols]
+
+        grouped = df.groupby(group_cols, observed=True, sort=False)
+        df_level = grouped[first_cols].first().join(
+            grouped[[numerator, denominator]].sum(min_count=1)
+            ).reset_index()
+
+        df_level = df_level.rename(columns={code_col: "area_code",
+                                            name_col: "area_name"})
+        if level == "ics":
+            df_level["ics_code"] = df_level["area_code"]
+            df_level["ics_name"] = df_level["area_name"]
+        df_level["level"] = level
+        frames.append(df_level)
+
+    return pd.concat(frames, ignore_index=True)
+
+#Compute the rollup rows for the target months from the monthly aggregates
+#The monthly aggregates must cover the 11 months before each target month
+def compute_rollup(df_months, dataset, target_months):
+    rollup = ROLLUPS[dataset]
+    numerator, denominator = rollup["numerator"], rollup["denominator"]
+    key_cols = ["level", "area_code"] + rollup["keys"]
+
+    #Shift every month forward into each window it belongs to
+    windows = []
+    for offset in range(WINDOW_MONTHS):
+        df_window = df_months[key_cols + ["month", numerator, denominator]]
+        df_window = df_window.assign(month=df_window["month"] + offset)
+        windows.append(df_window[df_window["month"].isin(target_months)])
+    df_windows = pd.concat(windows, ignore_index=True)
+
+    grouped = df_windows.groupby(key_cols + ["month"], sort=False)
+    df_rolling = grouped[[numerator, denominator]].sum(min_count=1)
+    df_rolling.columns = [numerator + "_12m", denominator + "_12m"]
+    df_rolling["months_12m"] = grouped.size()
+
+    #Keep the areas and breakdowns present in each target month
+    df_out = df_months[df_months["month"].isin(target_months)].merge(
+        df_rolling.reset_index(), on=key_cols + ["month"], how="left")
+
+    df_out["sickness_rate"] = (df_out[numerator] /
+                               df_out[denominator].where(
+                                   df_out[denominator] > 0))
+    df_out["sickness_rate_12m"] = (df_out[numerator + "_12m"] /
+                                   df_out[denominator + "_12m"].where(
+                                       df_out[denominator + "_12m"] > 0))
+    df_out["date_upload"] = datetime.today()
+
+    return df_out
+
+#Read the fact table rows needed for a rollup (between two dates if given)
+def read_fact(con, fact_table, dataset, start=None, end=None):
+    rollup = ROLLUPS[dataset]
+    columns = (["date_data", "org_code", "org_name", "ics_code", "ics_name"] +
+               rollup["keys"] + rollup["attributes"] +
+               [rollup["numerator"], rollup["denominator"]])
+
+    #Read in primary key order so the sums do not depend on the row order
+    query = select(*[fact_table.c[col] for col in columns]).order_by(
+        *fact_table.primary_key.columns)
+    if start is not None:
+        query = query.where(and_(fact_table.c.date_data >= start,
+                                 fact_table.c.date_data <= end))
+
+    return pd.DataFrame(con.execute(query).fetchall(), columns=columns)
+
+#Recompute the rollup rows affected by loading the given dates
+#If no dates are given the whole rollup is rebuilt
+#The caller is responsible for committing the transaction.
+def refresh_rollup(con, fact_table, rollup_table, dataset, dates=None,
+                   method="executemany", batch_size=1000,
+                   staging_dir="./data/staging/", con_debug=True):
+
+    with report.stage("rollup", table=rollup_table.name) as metrics:
+        if dates is None:
+            df_fact = read_fact(con, fact_table, dataset)
+            delete_query = delete(rollup_table)
+            first_month, last_month = None, None
+        else:
+            #Every month from the first date to 11 months after the last
+            #date is affected (this includes any months in between)
+            months = month_index(dates)
+            first_month = months.min()
+            last_month = months.max() + WINDOW_MONTHS - 1
+
+            df_fact = read_fact(
+                con, fact_table, dataset,
+                month_start(first_month - WINDOW_MONTHS + 1),
+                month_end(last_month))
+            delete_query = delete(rollup_table).where(
+                and_(rollup_table.c.date_data >= month_start(first_month),
+                     rollup_table.c.date_data <= month_end(last_month)))
+        metrics["rows_in"] = len(df_fact)
+
+        #Recompute every month in the affected range that has data
+        df_months = aggregate_months(df_fact, dataset)
+        target_months = df_months["month"].unique()
+        if first_month is not None:
+            target_months = target_months[(target_months >= first_month) &
+                                          (target_months <= last_month)]
+        df_rollup = compute_rollup(df_months, dataset, target_months)
+        metrics["months"] = len(target_months)
+        metrics["rows_out"] = len(df_rollup)
+
+        con.execute(delete_query)
+
+    columns = [col.name for col in rollup_table.columns]
+    return bulk_insert(con, rollup_table, df_rollup[columns], method,
+                       batch_size, staging_dir, con_debug)
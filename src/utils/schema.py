@@ -0,0 +1,56 @@
+import re
+
+from functools import lru_cache
+
+#This script reads the destination table definitions from the CREATE TABLE
+#scripts in the docs directory so source files and processed data can be
+#checked against them without connecting to the warehouse.
+
+#A column definition i.e. "org_code VARCHAR(5) NOT NULL"
+COLUMN_PATTERN = re.compile(
+    r"^\s*(\w+)\s+(\w+)\s*(?:\(\s*(\d+)\s*\))?\s*(NOT\s+NULL)?", re.I)
+
+#The primary key constraint i.e. "PRIMARY KEY (date_data, org_code)"
+PRIMARY_KEY_PATTERN = re.compile(r"PRIMARY\s+KEY\s*\(([^)]*)\)", re.I)
+
+#Parse a CREATE TABLE script (cached so each script is only read once)
+#Returns a dict with the table name, the columns (in order) with their type,
+#length and nullability and the primary key columns
+@lru_cache(maxsize=None)
+def parse_ddl(ddl_path):
+    with open(ddl_path) as file:
+        ddl = file.read()
+
+    #Remove comments
+    ddl = re.sub(r"--[^\n]*", "", ddl)
+
+    #The table name is the last part of the [database].[schema].[table] name
+    match = re.search(r"CREATE\s+TABLE\s+([^\s(]+)\s*\((.*)\)", ddl,
+                      re.I | re.S)
+    if not match:
+        raise Exception(f"No CREATE TABLE statement was found in {ddl_path}.")
+    table_name = match.group(1).split(".")[-1].strip("[]")
+    body = match.group(2)
+
+    #Read the primary key then remove it from the column definitions
+    primary_key = []
+    pk_match = PRIMARY_KEY_PATTERN.search(body)
+    if pk_match:
+        primary_key = [col.strip().strip("[]")
+                       for col in pk_match.group(1).split(",")]
+        body = body[:pk_match.start()] + body[pk_match.end():]
+
+    columns = {}
+    for definition in body.split(","):
+        col_match = COLUMN_PATTERN.match(definition)
+        if not col_match:
+            continue
+        name, col_type, length, not_null = col_match.groups()
+        columns[name] = {
+            "type": col_type.upper(),
+            "length": int(length) if length else None,
+            "nullable": not_null is None and name not in primary_key
+        }
+
+    return {"table": table_name, "columns": columns,
+            "primary_key": primary_key}
@@ -0,0 +1,168 @@
+import os
+
+from abc import ABC, abstractmethod
+from glob import glob
+from sqlalchemy import create_engine, event, inspect, text
+
+from utils.data_loading import create_table_from_ddl, get_tables
+from utils.schema import parse_ddl
+
+#This script defines the databases processed data can be loaded into (sinks).
+#Each sink provides an engine, the reflected destination tables and the
+#settings it needs to change (i.e. the load method) so the same load code
+#(upload_data in wf_sickness.py) writes to any of them:
+#"sqlserver" - The warehouse (using the [database] settings)
+#"sqlite"    - A local SQLite database file, created from the table scripts
+#              in the docs directory, so the pipeline can run without the
+#              warehouse (i.e. for testing, profiling and offline backfills)
+#The ICS lookup can be read from the warehouse or from a local csv file in
+#the same way (see LOOKUP_SOURCES).
+
+#Create the engine for the warehouse
+#The engine holds a connection pool so it should be created once per run
+def sqlserver_engine(dsn, database, pool_size=5):
+    #Create Connection String
+    conn_str = (f"mssql+pyodbc:///"
+                f"?odbc_connect=DSN={dsn};"
+                f"DATABASE={database};"
+                f"Trusted_Connection=yes;")
+
+    #Create SQL Alchemy Engine object
+    #(fast_executemany sends executemany batches to the server in bulk)
+    return create_engine(conn_str, use_setinputsizes=False,
+                         fast_executemany=True,
+                         pool_size=pool_size,
+                         pool_pre_ping=True)
+
+#A database the processed data is loaded into
+class Sink(ABC):
+    #File (in the cache directory) the reflected tables are cached in
+    reflection_cache = "reflection.pkl"
+
+    def __init__(self, name, settings, overrides=None):
+        self.name = name
+        self.settings = {**settings, **(overrides or {})}
+        self.engine = None
+        self.tables = None
+
+    #Create the engine for the sink
+    @abstractmethod
+    def create_engine(self):
+        pass
+
+    #Create any destination tables that do not exist (not done by default)
+    def create_tables(self, con, table_names):
+        pass
+
+    #Connect to the sink (once) and reflect the destination tables
+    def connect(self, table_names):
+        if self.engine is None:
+            self.engine = self.create_engine()
+
+        with self.engine.begin() as con:
+            self.create_tables(con, table_names)
+
+        self.tables = get_tables(
+            self.engine, self.settings["sql_schema"], table_names,
+            self.settings["cache_directory"] + self.reflection_cache)
+
+        return self
+
+#The warehouse
+class SqlServerSink(Sink):
+    def create_engine(self):
+        return sqlserver_engine(self.settings["sql_dsn"],
+                                self.settings["sql_database"],
+                                self.settings["sql_pool_size"])
+
+#A local SQLite database
+#Rows are appended using the sqlite3 driver's executemany (its native bulk
+#path) with a write ahead log and fewer disk syncs
+class SqliteSink(Sink):
+    reflection_cache = "reflection_sqlite.pkl"
+
+    def __init__(self, name, settings):
+        super().__init__(name, settings, {
+            "sql_schema": None,
+            "load_method": "executemany",
+            "load_batch_size": settings["sqlite_batch_size"]
+        })
+
+    def create_engine(self):
+        db_path = self.settings["sqlite_path"]
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        engine = create_engine("sqlite:///" + db_path)
+
+        @event.listens_for(engine, "connect")
+        def set_pragmas(dbapi_con, _):
+            cursor = dbapi_con.cursor()
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL")
+            cursor.close()
+
+        return engine
+
+    #Create the missing tables from the table scripts in the docs directory
+    def create_tables(self, con, table_names):
+        existing = set(inspect(con).get_table_names())
+        ddl_dir = os.path.dirname(self.settings["ddl_sickness"])
+
+        for ddl_path in sorted(glob(os.path.join(ddl_dir,
+                                                 "create_table_*.sql"))):
+            table_name = parse_ddl(ddl_path)["table"]
+            if table_name in table_names and table_name not in existing:
+                create_table_from_ddl(con, ddl_path)
+
+#The sinks available
+SINKS = {
+    "sqlserver": SqlServerSink,
+    "sqlite": SqliteSink
+}
+
+#Get the sinks named in the settings (not connected)
+def get_sinks(settings):
+    sinks = []
+    for name in settings["sinks"]:
+        if name not in SINKS:
+            raise Exception((f"The sink '{name}' is not supported. "
+                             f"The available sinks are: {', '.join(SINKS)}."))
+        sinks.append(SINKS[name](name, settings))
+
+    if sinks == []:
+        raise Exception(("No sinks were given in the [sinks] section of the "
+                         "config.toml file."))
+    return sinks
+
+#Read the ICS lookup from the warehouse using the lookup query
+def read_lookup_sqlserver(settings, engine=None):
+    import pandas as pd
+
+    engine = engine or sqlserver_engine(settings["sql_dsn"],
+                                        settings["sql_database"],
+                                        settings["sql_pool_size"])
+
+    with open(settings["ics_lookup"]) as file:
+        sfw_query = file.read()
+
+    with engine.connect() as con:
+        return pd.read_sql_query(text(sfw_query), con)
+
+#Read the ICS lookup from a local csv file
+#(with org_code, ics_code and ics_name columns)
+def read_lookup_csv(settings, engine=None):
+    import pandas as pd
+
+    df_lookup = pd.read_csv(settings["ics_lookup_csv"], dtype=str,
+                            keep_default_na=False)
+
+    missing = {"org_code", "ics_code", "ics_name"} - set(df_lookup.columns)
+    if missing:
+        raise Exception((f"The ICS lookup file {settings['ics_lookup_csv']} "
+                         f"is missing the columns: {', '.join(missing)}."))
+    return df_lookup
+
+#The sources the ICS lookup can be read from
+LOOKUP_SOURCES = {
+    "sqlserver": read_lookup_sqlserver,
+    "csv": read_lookup_csv
+}
@@ -0,0 +1,255 @@
+import hashlib
+import os
+import re
+import threading
+import numpy as np
+import pandas as pd
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from time import sleep
+from urllib.parse import quote, unquote
+
+#This script generates synthetic NHSD source files at national scale and
+#serves them from a local HTTP server that mimics the NHSD publication pages.
+#It is used by the benchmark suite (src/benchmark.py) so the pipeline can be
+#timed without access to NHSD or the warehouse.
+
+#NHSE regions (London is Y56)
+REGIONS = ["Y56", "Y58", "Y59", "Y60", "Y61", "Y62", "Y63"]
+
+#London ICBs [ics_code, ics_name]
+LONDON_ICS = [["QMJ", "North Central London"],
+              ["QRV", "North West London"],
+              ["QKK", "South East London"],
+              ["QMF", "North East London"],
+              ["QWE", "South West London"]]
+
+STAFF_GROUPS = [
+    "All staff groups", "HCHS Doctors", "Consultant", "Specialty Doctor",
+    "Nurses & health visitors", "Midwives", "Ambulance staff",
+    "Scientific, therapeutic & technical staff",
+    "Support to doctors, nurses & midwives", "Support to ambulance staff",
+    "Support to ST&T staff", "NHS infrastructure support",
+    "Central functions", "Hotel, property & estates", "Senior managers",
+    "Managers", "Other staff or those with unknown classification"]
+
+REASONS = [
+    "S10 Anxiety/stress/depression/other psychiatric illnesses",
+    "S11 Back problems", "S12 Other musculoskeletal problems",
+    "S13 Cold, Cough, Flu - Influenza", "S14 Asthma",
+    "S15 Chest & respiratory problems", "S16 Headache / migraine",
+    "S17 Benign and malignant tumours, cancers", "S18 Blood disorders",
+    "S19 Heart, cardiac & circulatory problems",
+    "S20 Burns, poisoning, frostbite, hypothermia",
+    "S21 Ear, nose, throat (ENT)", "S22 Dental and oral problems",
+    "S23 Eye problems", "S24 Endocrine / glandular problems",
+    "S25 Gastrointestinal problems",
+    "S26 Genitourinary & gynaecological disorders",
+    "S27 Infectious diseases", "S28 Injury, fracture",
+    "S29 Nervous system disorders", "S30 Pregnancy related disorders",
+    "S31 Skin disorders", "S32 Substance abuse",
+    "S98 Other known causes - not elsewhere classified",
+    "S99 Unknown causes / Not specified"]
+
+MONTH_NAMES = ["January", "February", "March", "April", "May", "June", "July",
+               "August", "September", "October", "November", "December"]
+
+#The NHSD file ids for each dataset
+FILE_IDS = {
+    "Sickness": "NHS Sickness Absence benchmarking tool CSV",
+    "ByReason": ("NHS Sickness Absence by reason, staff group and "
+                 "organisation CSV")
+}
+
+#Build the list of organisations with their region
+def get_organisations(n_orgs):
+    org_codes = np.array([f"R{i:03d}" for i in range(n_orgs)])
+
+    #Roughly 1 in 7 organisations are in London
+    regions = np.array(REGIONS)[np.arange(n_orgs) % len(REGIONS)]
+
+    #Make sure the organisations with ICS overrides are always included
+    org_codes[:2] = ["RAN", "RV3"]
+    regions[:2] = "Y56"
+
+    return pd.DataFrame({"org_code": org_codes, "region_code": regions,
+                         "org_name": np.char.add("Synthetic Trust ",
+                                                 org_codes)})
+
+#Build an ICS lookup (as returned by get_ics_lookup) for the London orgs
+def get_synthetic_ics_lookup(n_orgs):
+    df_orgs = get_organisations(n_orgs)
+    df_orgs = df_orgs[df_orgs["region_code"] == "Y56"].reset_index(drop=True)
+
+    ics = np.array(LONDON_ICS)[np.arange(len(df_orgs)) % len(LONDON_ICS)]
+    return pd.DataFrame({"org_code": df_orgs["org_code"],
+                         "ics_code": ics[:, 0], "ics_name": ics[:, 1]})
+
+#Generate a single month of synthetic data for a dataset
+def generate_month(dataset, period, n_orgs, seed=0):
+    rng = np.random.default_rng(seed)
+    df_orgs = get_organisations(n_orgs)
+    n_sg = len(STAFF_GROUPS)
+
+    #One row per organisation and staff group (and reason for By Reason)
+    org_idx = np.repeat(np.arange(n_orgs), n_sg)
+    sg_idx = np.tile(np.arange(n_sg), n_orgs)
+    if dataset == "ByReason":
+        org_idx = np.repeat(org_idx, len(REASONS))
+        sg_idx = np.repeat(sg_idx, len(REASONS))
+    n_rows = len(org_idx)
+
+    date_data = (pd.Timestamp(period) + pd.offsets.MonthEnd(0))
+
+    df = pd.DataFrame({
+        "DATE": date_data.strftime("%d/%m/%Y"),
+        "NHSE_REGION_CODE": df_orgs["region_code"].to_numpy()[org_idx],
+        "NHSE_REGION_NAME": "Synthetic Region",
+        "ORG_CODE": df_orgs["org_code"].to_numpy()[org_idx],
+        "ORG_NAME": df_orgs["org_name"].to_numpy()[org_idx],
+        "STAFF_GROUP": np.array(STAFF_GROUPS)[sg_idx]
+    })
+
+    if dataset == "ByReason":
+        df["REASON"] = np.tile(REASONS, n_rows // len(REASONS))
+        df["FTE_DAYS_LOST_REASON"] = np.round(rng.gamma(1.5, 20, n_rows), 2)
+
+    #Sickness rates are typically around 5%
+    days_available = np.round(rng.uniform(500, 50000, n_rows), 2)
+    df["FTE_DAYS_LOST"] = np.round(days_available *
+                                   rng.uniform(0.02, 0.08, n_rows), 2)
+    df["FTE_DAYS_AVAILABLE"] = days_available
+
+    #Small organisations often have suppressed values
+    missing = rng.random(n_rows) < 0.02
+    df.loc[missing, "FTE_DAYS_LOST"] = np.nan
+
+    return df
+
+#Get the source filename NHSD uses for a dataset and period
+def get_source_filename(dataset, period):
+    period = pd.Timestamp(period)
+    return (f"{FILE_IDS[dataset]}, {MONTH_NAMES[period.month - 1]} "
+            f"{period.year}.csv")
+
+#Write synthetic source files for each period and return their paths
+def generate_source_files(dest_dir, periods, n_orgs,
+                          datasets=("Sickness", "ByReason")):
+    os.makedirs(dest_dir, exist_ok=True)
+    paths = []
+
+    for i, period in enumerate(periods):
+        for dataset in datasets:
+            path = os.path.join(dest_dir, get_source_filename(dataset, period))
+            generate_month(dataset, period, n_orgs, seed=i).to_csv(
+                path, index=False)
+            paths.append(path)
+
+    return paths
+
+#Get the slug used for a period's page on NHSD (i.e. july-2024)
+def get_page_slug(period):
+    period = pd.Timestamp(period)
+    return f"{MONTH_NAMES[period.month - 1].lower()}-{period.year}"
+
+#Start a local HTTP server that mimics the NHSD publication pages
+#source_dir must contain files named using get_source_filename
+#latency adds a delay (in seconds) to every file download
+#drop_after closes the connection after that many bytes of each file response
+#(to test resumed downloads). Files are served with an MD5 ETag and support
+#range requests like the NHSD file server.
+def serve_nhsd_fixture(source_dir, periods, latency=0.0,
+                       publication="nhs-sickness-absence-rates",
+                       drop_after=None):
+
+    #Newest period first, as on the NHSD publication page
+    slugs = [get_page_slug(period) for period in
+             sorted(periods, key=pd.Timestamp, reverse=True)]
+    slug_periods = dict(zip(slugs, sorted(periods, key=pd.Timestamp,
+                                          reverse=True)))
+    section = "/data-and-information/publications/statistical/"
+
+    class NHSDHandler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def send_body(self, body, content_type="text/html"):
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_file(self, body):
+            etag = '"' + hashlib.md5(body).hexdigest() + '"'
+
+            #Only resume if the file has not changed (If-Range)
+            start = 0
+            range_match = re.match(r"bytes=(\d+)-", 
+                                   self.headers.get("Range", ""))
+            if range_match and self.headers.get("If-Range", etag) == etag:
+                start = min(int(range_match.group(1)), len(body))
+
+            if start > 0:
+                self.send_response(206)
+                self.send_header("Content-Range", 
+                                 f"bytes {start}-{len(body) - 1}/{len(body)}")
+            else:
+                self.send_response(200)
+            self.send_header("Content-Type", "text/csv")
+            self.send_header("Content-Length", str(len(body) - start))
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("ETag", etag)
+            self.end_headers()
+
+            #Drop the connection part way through the file
+            content = body[start:]
+            if drop_after is not None and len(content) > drop_after:
+                self.wfile.write(content[:drop_after])
+                self.close_connection = True
+                return
+            self.wfile.write(content)
+
+        def do_GET(self):
+            path = unquote(self.path)
+            base_url = f"http://127.0.0.1:{self.server.server_port}"
+
+            #Publication page listing the latest and past pages
+            if path == section + publication + "/":
+                links = [f'<a class="cta__button" href="{section}'
+                         f'{publication}/{slug}">{slug}</a>'
+                         for slug in slugs[1:]]
+                html = (f'<div id="latest-statistics"><a href="{section}'
+                        f'{publication}/{slugs[0]}">Latest</a></div>'
+                        f'<div id="past-publications">{"".join(links)}</div>')
+                self.send_body(html.encode())
+
+            #Period page listing the data files
+            elif path.startswith(section + publication + "/"):
+                slug = path.rstrip("/").split("/")[-1]
+                if slug not in slug_periods:
+                    self.send_error(404)
+                    return
+                links = [f'<a href="{base_url}/files/'
+                         f'{quote(get_source_filename(ds, slug_periods[slug]))}'
+                         '">file</a>' for ds in FILE_IDS]
+                html = f'<div id="resources">{"".join(links)}</div>'
+                self.send_body(html.encode())
+
+            #Data files
+            elif path.startswith("/files/"):
+                filepath = os.path.join(source_dir, path.split("/")[-1])
+                if not os.path.isfile(filepath):
+                    self.send_error(404)
+                    return
+                sleep(latency)
+                with open(filepath, "rb") as file:
+                    self.send_file(file.read())
+
+            else:
+                self.send_error(404)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), NHSDHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
@@ -0,0 +1,298 @@
+from utils.data_ingest import (get_source_columns, load_column_map, 
+                               probe_source_file, read_source_columns)
+from utils.schema import parse_ddl
+
+#This script checks source files before they are processed.
+#Only the header and the first rows of each file are read (the probe) so a
+#file NHSD has changed is rejected in milliseconds rather than failing part
+#way through the transform or the load.
+#The dataset in a file is worked out from its columns rather than its name.
+#The processed data is then checked against the table definition (primary
+#key, NOT NULL and length constraints) before it is loaded so bad rows are
+#reported in one pass rather than by a failed insert batch.
+
+#Columns added by the transform (process_benchmarking_data) and the mapped
+#source columns they are derived from
+DERIVED_COLUMNS = {
+    "ics_code": ["org_code"],
+    "ics_name": ["org_code"],
+    "reason_code": ["reason_full"],
+    "reason_desc": ["reason_full"],
+    "date_upload": []
+}
+
+#Mapped source columns the transform needs that are not loaded
+FILTER_COLUMNS = ["region_code"]
+
+#Datasets a source file can contain
+DATASETS = ["Sickness", "ByReason"]
+
+#Return the mapped (output) columns a file needs to load into a table
+def get_required_columns(ddl):
+    required = set(FILTER_COLUMNS)
+    for col in ddl["columns"]:
+        required.update(DERIVED_COLUMNS.get(col, [col]))
+    return required
+
+#Map the source columns of a file to their output names
+#Returns a dict of output name to the source columns in the file
+def map_source_columns(columns, df_map):
+    source_map = df_map.groupby("source_name")["output_name"].first()
+
+    mapped = {}
+    for col in columns:
+        if col in source_map.index:
+            mapped.setdefault(source_map[col], []).append(col)
+    return mapped
+
+#Work out the dataset of a file from its mapped columns
+#The dataset with no missing columns that uses the most columns is chosen
+#(a By Reason file also has every column of a Sickness file)
+#Returns the dataset (None if there is no match) and any problems found
+def classify_columns(mapped, settings):
+    candidates = []
+    for file_type in DATASETS:
+        ddl = parse_ddl(settings["ddl_" + file_type.lower()])
+        required = get_required_columns(ddl)
+        missing = sorted(required - set(mapped))
+        candidates.append((len(missing), -len(required), file_type, missing))
+
+    n_missing, _, file_type, missing = min(candidates)
+    if n_missing > 0:
+        return None, [(f"The columns do not match any dataset. The closest is "
+                       f"{file_type} which is missing: {', '.join(missing)} "
+                       f"(check {settings['map_column']}).")]
+    return file_type, []
+
+#Parse dates the way parse_dates does (in the expected format or a format that
+#can be inferred). A ValueError is raised if they cannot be read.
+def parse_sample_dates(values, date_format):
+    import pandas as pd
+
+    try:
+        return pd.to_datetime(values, format=date_format)
+    except ValueError:
+        return pd.to_datetime(values, dayfirst=True)
+
+#Check the values in the sample rows can be read
+def check_sample(df_sample, mapped, file_type, settings):
+    import pandas as pd
+
+    problems = []
+    df_map = load_column_map(settings["map_column"])
+    ddl = parse_ddl(settings["ddl_" + file_type.lower()])
+    dtypes = df_map.groupby("output_name")["dtype"].first()
+
+    for output_name, source_cols in mapped.items():
+        #Only columns used by the dataset are checked
+        if output_name not in get_required_columns(ddl):
+            continue
+
+        values = df_sample[source_cols[0]].dropna()
+
+        #Numeric columns must be numbers
+        if dtypes.get(output_name) == "float64":
+            invalid = values[pd.to_numeric(values, errors="coerce").isna()]
+            if len(invalid) > 0:
+                problems.append((f"{source_cols[0]} contains values that are "
+                                 f"not numbers (i.e. '{invalid.iloc[0]}')."))
+
+        #The date column must be readable by parse_dates
+        elif output_name == "date_data" and len(values) > 0:
+            try:
+                parse_sample_dates(values.unique(), settings["date_format"])
+            except ValueError as e:
+                problems.append((f"{source_cols[0]} contains values that "
+                                 f"are not dates ({e})."))
+
+    return problems
+
+#Work out the dataset of each sample from its mapped columns
+#Returns a list of [member name, sample frame, mapped columns, dataset, 
+#problems] (the dataset is None if the columns do not match a dataset)
+def classify_samples(samples, settings):
+    df_map = load_column_map(settings["map_column"])
+
+    classified = []
+    for member, df_sample in samples:
+        mapped = map_source_columns(df_sample.columns, df_map)
+        file_type, problems = classify_columns(mapped, settings)
+        classified.append([member, df_sample, mapped, file_type, problems])
+    return classified
+
+#Probe a source file to find its dataset and check it can be processed
+#CSV members of a ZIP file that do not match a dataset (i.e. a metadata file)
+#are skipped rather than rejecting the file.
+#Returns the dataset (None if the file should be rejected), any problems and
+#the names of the skipped members
+def classify_source_file(filepath, settings):
+    try:
+        samples = probe_source_file(filepath, settings["probe_rows"])
+    except Exception as e:
+        return None, [f"The file could not be read ({e})."], []
+    if samples == []:
+        return None, ["The zip file contains no csv files."], []
+
+    classified = classify_samples(samples, settings)
+
+    #Names are only given for the members of ZIP archives
+    skipped = [member for member, _, _, file_type, _ in classified
+               if member is not None and file_type is None]
+    if skipped and len(skipped) == len(classified):
+        return None, [f"{member}: {problem}" 
+                      for member, _, _, _, problems in classified
+                      for problem in problems], skipped
+
+    file_types = set()
+    problems = []
+    for member, df_sample, mapped, file_type, type_problems in classified:
+        if member in skipped:
+            continue
+        prefix = f"{member}: " if member else ""
+
+        #Two source columns for the same output column would be ambiguous
+        for output_name, source_cols in mapped.items():
+            if len(source_cols) > 1:
+                problems.append((f"{prefix}The columns "
+                                 f"{', '.join(source_cols)} all map to "
+                                 f"{output_name}."))
+
+        problems += [prefix + problem for problem in type_problems]
+        if file_type is None:
+            continue
+        file_types.add(file_type)
+
+        problems += [prefix + problem for problem in
+                     check_sample(df_sample, mapped, file_type, settings)]
+
+    if len(file_types) > 1:
+        problems.append("The zip file contains more than one dataset.")
+
+    if problems or len(file_types) != 1:
+        return None, problems, skipped
+    return file_types.pop(), [], skipped
+
+#Get the CSV members of a source file that hold the given dataset
+#Returns None for CSV (and gzip) files
+def get_dataset_members(filepath, file_type, settings):
+    samples = probe_source_file(filepath, settings["probe_rows"])
+    if samples[0][0] is None:
+        return None
+
+    return [member for member, _, _, member_type, _ 
+            in classify_samples(samples, settings) if member_type == file_type]
+
+#Get the months of the data in a source file (from every row of its date 
+#column as NHSD sometimes publish several months in one file)
+#Returns a sorted list of months (YYYY-MM)
+def get_file_periods(filepath, file_type, settings):
+    df_map = load_column_map(settings["map_column"])
+    date_columns = set(get_source_columns(df_map, "date_data"))
+    members = get_dataset_members(filepath, file_type, settings)
+
+    periods = set()
+    for df_dates in read_source_columns(filepath, date_columns, members):
+        if len(df_dates.columns) == 0:
+            continue
+        dates = parse_sample_dates(df_dates.iloc[:, 0].dropna().unique(),
+                                   settings["date_format"])
+        periods.update(str(period) for period in 
+                       dates.to_period("M").unique())
+
+    return sorted(periods)
+
+#Text types whose length is checked against the table definition
+TEXT_TYPES = ["CHAR", "VARCHAR", "NCHAR", "NVARCHAR"]
+
+#Number of example values shown for each violation
+N_EXAMPLES = 3
+
+#Longest example value shown (longer values are cut short)
+EXAMPLE_LENGTH = 40
+
+#Format the example values of a violation
+def format_examples(df_examples):
+    examples = df_examples.drop_duplicates().head(N_EXAMPLES)
+
+    def format_value(value):
+        value = str(value.date()) if hasattr(value, "date") else str(value)
+        if len(value) > EXAMPLE_LENGTH:
+            return value[:EXAMPLE_LENGTH] + "..."
+        return value
+
+    return "; ".join(", ".join(format_value(value) for value in row)
+                     for row in examples.itertuples(index=False))
+
+#Return the lengths of the values in a text column (nulls are 0)
+#Categorical columns only measure each category once
+def text_lengths(series):
+    import numpy as np
+    import pandas as pd
+
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        lengths = np.append(series.cat.categories.astype(str).str.len(), 0)
+        return lengths[series.cat.codes.to_numpy()]
+    return series.astype(str).str.len().where(series.notna(), 0).to_numpy()
+
+#Check processed data against the destination table definition
+#Returns a list of violations [check, columns, rows, examples]
+def validate_processed(df, file_type, settings):
+    import pandas as pd
+
+    ddl = parse_ddl(settings["ddl_" + file_type.lower()])
+    violations = []
+
+    #Columns that are missing from the data
+    missing = [col for col in ddl["columns"] if col not in df.columns]
+    if missing:
+        violations.append(["missing column", ", ".join(missing), len(df), ""])
+
+    #Duplicate primary keys (rows are hashed so only one column is grouped)
+    primary_key = [col for col in ddl["primary_key"] if col in df.columns]
+    if primary_key and len(df) > 0:
+        key_hash = pd.util.hash_pandas_object(df[primary_key], index=False)
+        duplicated = key_hash.duplicated(keep=False).to_numpy()
+
+        #Confirm the hash matches are real duplicates
+        if duplicated.any():
+            df_keys = df.loc[duplicated, primary_key]
+            df_keys = df_keys[df_keys.duplicated(keep=False)]
+            if len(df_keys) > 0:
+                violations.append(["duplicate primary key",
+                                   ", ".join(primary_key), len(df_keys),
+                                   format_examples(df_keys)])
+
+    for col, definition in ddl["columns"].items():
+        if col not in df.columns:
+            continue
+
+        #Missing values in NOT NULL columns
+        if not definition["nullable"]:
+            nulls = df[col].isna().to_numpy()
+            if nulls.any():
+                #A missing ICS is caused by an org missing from the lookup
+                example_cols = (["org_code"] if col.startswith("ics_") and
+                                "org_code" in df.columns else primary_key)
+                violations.append(["null value", col, int(nulls.sum()),
+                                   format_examples(df.loc[nulls, 
+                                                          example_cols])])
+
+        #Values too long for the column
+        if definition["type"] in TEXT_TYPES and definition["length"]:
+            too_long = text_lengths(df[col]) > definition["length"]
+            if too_long.any():
+                violations.append([f"longer than {definition['length']}", 
+                                   col, int(too_long.sum()),
+                                   format_examples(df.loc[too_long, [col]])])
+
+    return violations
+
+#Format the violations found in a file as a compact report
+def format_violations(filename, violations):
+    lines = [f"The processed data for {filename} failed validation:"]
+    for check, columns, rows, examples in violations:
+        line = f"  - {check} ({columns}): {rows:,} rows"
+        if examples:
+            line += f" e.g. {examples}"
+        lines.append(line)
+    return "\n".join(lines)
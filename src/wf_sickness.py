@@ -1,27 +1,55 @@
-import pandas as pd
-import numpy as np
+import argparse
+import hashlib
+import json
 import os
+import threading
+import time
 import re
 import toml
-import tkinter as tk
 
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
 from dotenv import load_dotenv
 from os import getenv
-from sqlalchemy import create_engine, MetaData, text, insert
-from sqlalchemy.orm import sessionmaker
-from tkinter import messagebox
 
-from utils.data_scraping import *
+from utils.data_ingest import *
+from utils.instrumentation import report
 
-##Global Variables
-overwrite_warning = True
-overwrite = True
+#pandas, SQLAlchemy and the scraping, transform and loading modules
+#are imported in the functions that use them so each command only loads what
+#it needs (i.e. the scrape command does not load pandas or SQLAlchemy)
 
 ##Functions
 
+#Read the command line arguments
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Load the NHSD sickness data into the warehouse.")
+    parser.add_argument("command", nargs="?", default="run",
+                        choices=list(COMMANDS),
+                        help=("The step to run: scrape, process (into the "
+                              "processed cache), load, archive, rebuild "
+                              "(reload every table from the archive), watch "
+                              "(keep loading new files as they arrive) or "
+                              "run (scrape if enabled and load, the "
+                              "default)."))
+    #The code never prompts the user so this does nothing (it is kept so 
+    #existing scheduled commands still run)
+    parser.add_argument("--headless", action="store_true",
+                        help=("No longer needed (nothing prompts the user), "
+                              "kept for compatibility."))
+    parser.add_argument("--force", action="store_true",
+                        help="Reload files that have already been loaded.")
+    parser.add_argument("--refresh-lookup", action="store_true",
+                        help="Refresh the cached ICS lookup from the database.")
+    parser.add_argument("--profile", action="store_true",
+                        help="Profile the run with cProfile.")
+
+    return parser.parse_args(argv)
+
 #Return an object containing all runtime settings
-def load_settings():
+def load_settings(args=None):
     #Load env settings
     load_dotenv(override=True)
 
@@ -35,7 +63,25 @@ def load_settings():
         "sql_schema": config["database"]["sql_schema"],
         "sql_table_sickness": config["database"]["sql_table_sickness"],
         "sql_table_byreason": config["database"]["sql_table_byreason"],
+        "sql_table_sickness_rollup": 
+            config["database"]["sql_table_sickness_rollup"],
+        "sql_table_byreason_rollup": 
+            config["database"]["sql_table_byreason_rollup"],
         "sql_cooloff": config["database"]["sql_cooloff"],
+        "sql_pool_size": config["database"]["sql_pool_size"],
+
+        #Databases the data is loaded into
+        "sinks": config["sinks"]["targets"],
+        "sinks_parallel": config["sinks"]["parallel"],
+        "sqlite_path": config["sinks"]["sqlite"]["path"],
+        "sqlite_batch_size": config["sinks"]["sqlite"]["batch_size"],
+
+        #Warehouse load settings
+        "load_mode": config["loading"]["mode"],
+        "load_method": config["loading"]["method"],
+        "load_batch_size": config["loading"]["batch_size"],
+        "load_staging_dir": config["loading"]["staging_dir"],
+        "rollups_enabled": config["rollups"]["enabled"],
 
         #Volatile user settings
         "scrape_new_data": True if (
@@ -47,12 +93,9 @@ def load_settings():
         "data_archive": True if (
             getenv("SOURCE_ARCHIVE") and getenv("SOURCE_ARCHIVE") != "False"
             ) else False,
-        "overwrite_warning": True if (
-            getenv("OVERWRITE_WARN") and getenv("OVERWRITE_WARN") != "False"
-            ) else False,
-        "overwrite_default": True if (
-            getenv("OVERWRITE_DEFAULT") 
-            and getenv("OVERWRITE_DEFAULT") != "False"
+        "ingest_force": True if (
+            (args is not None and args.force) or 
+            (getenv("INGEST_FORCE") and getenv("INGEST_FORCE") != "False")
             ) else False,
 
         #Structure information
@@ -60,34 +103,99 @@ def load_settings():
                              "/" + config["struct"]["source_dir"] + "/"),
         "archive_directory": ("./" + config["struct"]["data_dir"] + "/" + 
                               config["struct"]["archive_dir"] + "/"),
+        "cache_directory": ("./" + config["struct"]["data_dir"] + "/" + 
+                            config["struct"]["cache_dir"] + "/"),
+        "report_directory": ("./" + config["struct"]["data_dir"] + "/" + 
+                             config["struct"]["report_dir"] + "/"),
+        "archive_compress_level": config["archive"]["compress_level"],
+        "processed_cache_directory": ("./" + config["struct"]["data_dir"] + 
+                                      "/" + config["struct"]["cache_dir"] + 
+                                      "/" + config["processed_cache"]["dir"] + 
+                                      "/"),
+
+        #Run report settings
+        "report_trace_memory": config["report"]["trace_memory"],
+        "report_profile": True if (
+            (args is not None and args.profile) or
+            (getenv("PROFILE_RUN") and getenv("PROFILE_RUN") != "False")
+            ) else False,
 
         #Lookup / reference values
         "map_column": config["map_files"]["column_names"],
         "ics_lookup": config["map_files"]["ics_lookup"],
+        "ics_lookup_cache": ("./" + config["struct"]["data_dir"] + "/" + 
+                             config["struct"]["cache_dir"] + "/" +
+                             config["ics_lookup"]["cache_file"]),
+        "ics_lookup_ttl": config["ics_lookup"]["ttl_hours"],
+        "ics_lookup_source": config["ics_lookup"]["source"],
+        "ics_lookup_csv": config["ics_lookup"]["csv_file"],
+        "ics_lookup_refresh": True if (
+            (args is not None and args.refresh_lookup) or
+            (getenv("ICS_LOOKUP_REFRESH") and 
+             getenv("ICS_LOOKUP_REFRESH") != "False")
+            ) else False,
+        "ics_override": config["codes"]["ics_override"],
         "region_code_london": config["codes"]["region_london"],
 
+        #Source file reading settings
+        "ingest_mode": config["ingest"]["mode"].lower(),
+        "ingest_chunksize": config["ingest"]["chunk_size"],
+        "date_format": config["ingest"]["date_format"],
+        "probe_rows": config["ingest"]["probe_rows"],
+        "validate_enabled": config["ingest"]["validate"],
+        "ddl_sickness": config["map_files"]["ddl_sickness"],
+        "ddl_byreason": config["map_files"]["ddl_byreason"],
+        "processed_cache": config["processed_cache"]["enabled"],
+        "pipeline_enabled": config["pipeline"]["enabled"],
+        "pipeline_workers": config["pipeline"]["workers"],
+        "ingest_ledger": ("./" + config["struct"]["data_dir"] + "/" + 
+                          config["struct"]["cache_dir"] + "/" +
+                          config["ingest"]["ledger_file"]),
+
         #Data scraping settings
-        "scrape_mode": getenv("SOURCE_SCRAPE_MODE").lower(),
+        "scrape_mode": (getenv("SOURCE_SCRAPE_MODE") or "Latest").lower(),
         "publication_name": config["data_scraping"]["publication_name"],
-        "target_files": config["data_scraping"]["target_files"]
+        "target_files": config["data_scraping"]["target_files"],
+        "scrape_workers": config["data_scraping"]["max_workers"],
+        "scrape_retries": config["data_scraping"]["retries"],
+        "scrape_backoff": config["data_scraping"]["backoff"],
+        "scrape_timeout": config["data_scraping"]["timeout"],
+        "scrape_page_cache_ttl": config["data_scraping"]["page_cache_ttl"],
+        "scrape_checkpoint": ("./" + config["struct"]["data_dir"] + "/" + 
+                              config["struct"]["cache_dir"] + "/" +
+                              config["data_scraping"]["checkpoint_file"]),
+
+        #Watch settings
+        "watch_poll_seconds": config["watch"]["poll_seconds"],
+        "watch_debounce_seconds": config["watch"]["debounce_seconds"],
+        "watch_scrape_minutes": config["watch"]["scrape_minutes"]
     }
 
     return settings
 
 #Use data scraping to fetch files directly from NHSD
 def scrape_new_data(settings):
+    from utils.data_scraping import data_scrape
+
     target_publicaton = settings["publication_name"]
     target_files = settings["target_files"]
     target_dir = settings["source_directory"]
     scrape_mode = settings["scrape_mode"]
 
     #Parse the specified SOURCE_SCRAPE_MODE
-    #Check if the given value is in the form "mode n" and if not set n to 1.
-    if len(scrape_mode.split(" ")) > 1:
-        mode_type, mode_n = scrape_mode.split(" ")
-    else:
-        mode_type = scrape_mode
-        mode_n = 1
+    #"Range start end" gives the first and last release month (YYYY-MM)
+    #Otherwise check if the value is in the form "mode n" (n defaults to 1)
+    mode_parts = scrape_mode.split(" ")
+    mode_type = mode_parts[0]
+    mode_n = 1
+    mode_range = None
+    if mode_type == "range":
+        if len(mode_parts) != 3:
+            raise Exception(("The range scrape mode should be in the form "
+                             "'Range YYYY-MM YYYY-MM'."))
+        mode_range = (mode_parts[1], mode_parts[2])
+    elif len(mode_parts) > 1:
+        mode_n = mode_parts[1]
 
     #Call the data scraping code
     data_scrape(publication_name=target_publicaton, 
@@ -95,7 +203,17 @@ def scrape_new_data(settings):
                 dest_dir=target_dir,
                 mode=mode_type,
                 mode_n=int(mode_n),
-                con_debug=True)
+                mode_range=mode_range,
+                con_debug=True,
+                max_workers=settings["scrape_workers"],
+                retries=settings["scrape_retries"],
+                backoff=settings["scrape_backoff"],
+                timeout=settings["scrape_timeout"],
+                manifest_path=settings["cache_directory"] + 
+                    "scrape_manifest.json",
+                cache_dir=settings["cache_directory"] + "pages/",
+                cache_ttl=settings["scrape_page_cache_ttl"],
+                checkpoint_path=settings["scrape_checkpoint"])
 
 #Function that renames the source file with a more appropiate filename
 def filename_cleanse(old_filename, file_type, settings):
@@ -142,8 +260,10 @@ def filename_cleanse(old_filename, file_type, settings):
                          "\n Full details on source filenames are found in the " 
                          "README.md file"))
     
-    #Derrive the cleansed file name
-    new_filename = f"Sickness {file_type} - " + fn_year +" "+ fn_month + ".csv"
+    #Derrive the cleansed file name (keeping the extension, i.e. .csv or .zip)
+    extension = os.path.splitext(old_filename)[1].lower()
+    new_filename = (f"Sickness {file_type} - " + fn_year +" "+ fn_month + 
+                    extension)
     
     #If the file was already cleansed, no need to check for filename conflicts
     if old_filename == new_filename:
@@ -162,327 +282,980 @@ def filename_cleanse(old_filename, file_type, settings):
 
     return new_filename
 
-#Establish a connection to the database
-def db_connect(dsn, database):
-    
-    #Create Connection String
-    conn_str = (f"mssql+pyodbc:///"
-                f"?odbc_connect=DSN={dsn};"
-                f"DATABASE={database};"
-                f"Trusted_Connection=yes;")
-    
-    #Create SQL Alchemy Engine object
-    engine = create_engine(conn_str, use_setinputsizes=False)
+#Connect to each sink the data is loaded into and reflect its tables
+#The warehouse engine is reused for the ICS lookup when it is a sink
+def connect_sinks(settings):
+    from utils.sinks import get_sinks
+
+    table_names = get_destination_table_names(settings)
+    return [sink.connect(table_names) for sink in get_sinks(settings)]
 
-    return engine
+#Get the warehouse engine from the sinks (if the warehouse is a sink)
+def get_warehouse_engine(sinks):
+    for sink in sinks:
+        if sink.name == "sqlserver":
+            return sink.engine
+    return None
 
-#Return a list of all csv files in the data/current directory
+#Return a list of all csv (and zip) files in the data/current directory
 def get_source_files(settings):
     #Get all files in the source data directory
     data_dir = settings["source_directory"]
     dir_list = os.listdir(data_dir)
 
-    #Cleanse the list
+    #An empty directory is the normal result of a run with nothing new (the
+    #loaded files are archived and unchanged downloads are skipped)
     if dir_list == []:
-        raise Exception(
-            ("\n\nNo files were found."
-             "\nThe NHSD data should be saved in the "
-             f"'{os.path.abspath(data_dir)}' directory.")
-        )
+        print("\nNo files were found. The NHSD data should be saved in the "
+              f"'{os.path.abspath(data_dir)}' directory.")
+        return []
 
-    #Ensure all data is a csv file
+    #Ensure all data is a csv file (or a zip file containing csv files)
     csv_files = []
 
     #Validate each source file
     for sf in dir_list:
-        if not(sf.endswith(".csv")):
-            print(f"Warning: {sf} is not a csv file and will not be processed.")
+        #Skip files that are still being downloaded
+        if sf.endswith(".part"):
+            continue
+        if not(sf.lower().endswith((".csv", ".zip"))):
+            print((f"Warning: {sf} is not a csv or zip file and will not be "
+                   "processed."))
         else:
             csv_files.append(sf)
 
     return csv_files
 
-#The NHSD Data files change over time
-def process_benchmarking_data(df_in, file_type, ics_lookup, settings):
- 
-    #Work using a clean copy of the data frame
-    df = df_in.copy()
-
-    #Map column names (and drop unused columns)
-    ##Load the map file
-    dir_map = settings["map_column"]
-    df_map = pd.read_csv(dir_map)
-    ##Apply the map on the column names
-    df.rename(columns=df_map.set_index("source_name")["output_name"], 
-              inplace=True)
-    
-    ##Remove unused columns (columns not specified in the map file)
-    df = df[df.columns.intersection(df_map["output_name"].values)]
+#Function to get the ICS mapping information
+#The lookup is cached locally and only queried from the Dictionary database
+#when the cache is older than the TTL, the lookup query changes or a refresh
+#is requested. A local lookup file (ics_lookup source = "csv") is read 
+#directly. The engine is only created if the warehouse needs to be queried.
+def get_ics_lookup(settings, engine=None):
+    import pandas as pd
+    from utils.data_transform import build_ics_mapping
+    from utils.sinks import LOOKUP_SOURCES
+
+    source = settings["ics_lookup_source"]
+    if source not in LOOKUP_SOURCES:
+        raise Exception((f"The ICS lookup source '{source}' is not supported. "
+                         "The available sources are: "
+                         f"{', '.join(LOOKUP_SOURCES)}."))
+    if source != "sqlserver":
+        df_out = LOOKUP_SOURCES[source](settings)
+        return build_ics_mapping(df_out.drop(columns="org_name", 
+                                             errors="ignore"), settings)
+
+    cache_path = settings["ics_lookup_cache"]
+    meta_path = cache_path + ".json"
+
+    #Fingerprint the lookup query so the cache is invalidated if it changes
+    with open(settings["ics_lookup"]) as file:
+        sfw_query = file.read()
+    query_hash = hashlib.sha256(sfw_query.encode()).hexdigest()
+
+    #Use the cached lookup if it is still valid
+    if (not settings["ics_lookup_refresh"] and 
+        os.path.isfile(cache_path) and os.path.isfile(meta_path)):
+        with open(meta_path) as file:
+            meta = json.load(file)
+        age_hours = (datetime.now() - 
+                     datetime.fromisoformat(meta["created"])
+                     ).total_seconds() / 3600
+        if (meta["query_hash"] == query_hash and 
+            age_hours < settings["ics_lookup_ttl"]):
+            df_out = pd.read_csv(cache_path, dtype=str, keep_default_na=False)
+            return build_ics_mapping(df_out, settings)
+
+    #Load the ICS Lookup sql script and store the results
+    df_out = LOOKUP_SOURCES[source](settings, engine)
 
-    #Filter to London only
-    region_code = settings["region_code_london"]
-    df = df[df["region_code"] == region_code]
+    df_out.drop("org_name", axis=1, inplace=True)
 
-    #Drop the region_code column
-    df.drop("region_code", axis=1, inplace=True)
+    #Save the lookup to the cache
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    df_out.to_csv(cache_path, index=False)
+    with open(meta_path, "w") as file:
+        json.dump({"created": datetime.now().isoformat(timespec="seconds"),
+                   "query_hash": query_hash}, file, indent=2)
 
-    #Replace Nans with None
-    df = df.replace({np.nan: None})
+    return build_ics_mapping(df_out, settings)
 
-    #By Reason specific processing
-    if file_type == "ByReason":
-        #Split reason_full column into code and description
-        df["reason_code"] = df["reason_full"].str[0:3]
-        df["reason_desc"] = df["reason_full"].str[4:]
-        df.drop(["reason_full"], axis=1, inplace=True)
+#Function that handles the file archiving
+#The file is compressed into the archive store (keyed on its hash) and removed
+#from the source directory
+#Returns whether a new copy was stored (False if it was already archived)
+def archive_file(filename, file_type, file_hash, settings):
+    from utils.archive_store import store_file
+    from utils.validation import get_file_periods
 
-    #Add ics columns using the dictionary table
-    df = df.join(ics_lookup.set_index("org_code"), on="org_code")
+    file_source = settings["source_directory"] + filename
 
-    #Fix issue with RNOH and CNWL ics_code
-    #In some NHSE datasets, RNOH is labelled as NWL and CNWL is labelled as NCL
-    df.loc[df["org_code"] == "RAN", "ics_code"] = "QMJ"
-    df.loc[df["org_code"] == "RAN", "ics_name"] = "North Central London"
-    df.loc[df["org_code"] == "RV3", "ics_code"] = "QRV"
-    df.loc[df["org_code"] == "RV3", "ics_name"] = "North West London"
+    #Record the months of the data so revisions of a month can be found
+    periods = get_file_periods(file_source, file_type, settings)
 
-    #Add a current timestamp to the data
-    df["date_upload"] = datetime.today()
+    return store_file(file_source, file_hash, file_type, periods,
+                      settings["archive_directory"],
+                      settings["archive_compress_level"])
 
-    #Convert existing date column to date object
-    df["date_data"] = pd.to_datetime(df["date_data"], dayfirst=True)
-    
-    return df
+#Get the names of the destination tables
+def get_destination_table_names(settings):
+    table_names = [settings["sql_table_sickness"], 
+                   settings["sql_table_byreason"]]
+    if settings["rollups_enabled"]:
+        table_names += [settings["sql_table_sickness_rollup"],
+                        settings["sql_table_byreason_rollup"]]
 
-#Function to get the ICS mapping information
-def get_ics_lookup(settings):
-   
-    #Set up Database Connection
-    dsn = settings["sql_dsn"]
-    sql_database = settings["sql_database"]
-
-    #Connect to the database
-    engine = db_connect(dsn, sql_database)
-    with engine.connect() as con:
-        
-        #Load the ICS Lookup sql script and store the results
-        with open(settings["ics_lookup"]) as file:
-            sfw_query = text(file.read())
-            df_out = pd.read_sql_query(sfw_query, con)
+    return table_names
 
-    df_out.drop("org_name", axis=1, inplace=True)
+#Function to upload data for a given dataset
+def upload_data(sf, df, dataset, settings, engine, tables):
+    import pandas as pd
+    from sqlalchemy import delete
+    from utils.data_loading import bulk_insert, delta_upsert, merge_upsert
 
-    return df_out
+    #Load destination table name
+    try:
+        sql_table = settings["sql_table_" + dataset.lower()]
+    except:
+        raise Exception((f"'sql_table_{dataset}' was not found in the"
+                          "'[database]' section of the config.toml file."))
 
-#Prompt the user to decide how to handle file name conflicts when archiving.
-def overwrite_prompt(filename):
-    
-    root = tk.Tk()
-    root.withdraw()
-
-    # Create a new top-level window
-    dialog = tk.Toplevel(root)
-    dialog.title("File already exists")
-    #dialog.geometry("500x150")
-
-    popup_font = ("Arial", 12)
-
-    # Add a description label
-    desc_text = f"""The file: "{filename}" already exists in the archive folder. 
-    \nDo you want to overwrite it?"""
-    label = tk.Label(dialog, text=desc_text, font=popup_font)
-    label.pack(padx = 20, pady=10)
-
-    # Variable to store checkbox state
-    apply_to_all_var = tk.BooleanVar()
-
-    # Add a checkbox
-    checkbox = tk.Checkbutton(dialog, 
-                              text="Apply my choice to all future conflicts", 
-                              variable=apply_to_all_var,
-                              font=popup_font)
-    checkbox.pack(pady=5)
-
-    # Variable to store the user's choice
-    result = tk.StringVar(value="")
-
-    # Function to handle button click and set result
-    def on_button_click(choice):
-        result.set(choice)
-        dialog.destroy()
-
-    # Create Yes and No buttons
-    yes_button = tk.Button(dialog, 
-                           text="Yes", 
-                           command=lambda: on_button_click(True),
-                           font=popup_font,
-                           height=1, width = 8)
-    no_button = tk.Button(dialog, 
-                          text="No", 
-                          command=lambda: on_button_click(False),
-                          font=popup_font,
-                          height=1, width = 8)
-    
+    sqlalc_table = tables[sql_table]
+
+    #Merge mode stages the data and replaces every date in it in one pass
+    #(the staged load and merge are recorded in the run report)
+    if settings["load_mode"] == "merge":
+        with engine.begin() as con:
+            merge_upsert(con, sqlalc_table, df,
+                         method=settings["load_method"],
+                         batch_size=settings["load_batch_size"],
+                         staging_dir=settings["load_staging_dir"])
+            update_rollup(con, df["date_data"].unique(), dataset, settings, 
+                          tables)
+
+    #Delta mode only writes the rows that differ from the destination
+    #(the rollup is only refreshed for dates where something changed)
+    elif settings["load_mode"] == "delta":
+        with engine.begin() as con:
+            changes = delta_upsert(con, sqlalc_table, df,
+                                   method=settings["load_method"],
+                                   batch_size=settings["load_batch_size"],
+                                   staging_dir=settings["load_staging_dir"])
+            update_rollup(con, changes["dates"], dataset, settings, tables)
+
+    #Replace mode deletes the existing data for the date then inserts
+    else:
+        ##Delete existing overlapping data to allow for re-uploading
+        data_daterange = df["date_data"].unique()
+        if len(data_daterange) > 1:
+            raise Warning(("Multiple dates were found in the data.\n"
+                          "This process does not replace existing data in the "
+                          "destination for files with multiple dates.\n"
+                          "Set the load mode to merge to load these files."))
+
+        with engine.connect() as con:
+
+            #If there is only a single date in the data
+            if len(data_daterange) == 1:
+                #Delete existing data from the destination for this data point
+                with report.stage("delete", table=sql_table) as metrics:
+                    result = con.execute(
+                        delete(sqlalc_table).where(
+                            sqlalc_table.c.date_data == 
+                            pd.Timestamp(data_daterange[0]).date())
+                    )
+                    metrics["rows_deleted"] = result.rowcount
+            
+            #Bulk load the data using the configured load method
+            bulk_insert(con, sqlalc_table, df,
+                        method=settings["load_method"],
+                        batch_size=settings["load_batch_size"],
+                        staging_dir=settings["load_staging_dir"])
+
+            update_rollup(con, data_daterange, dataset, settings, tables)
+
+            con.commit()
+
+    return len(df)
+
+#Call a load function for every sink (with the sink's settings, engine and 
+#tables after the given arguments)
+#When there are several sinks they are loaded at the same time if enabled
+#Returns the result for each sink
+def run_on_sinks(load_function, args, settings, sinks):
+    if len(sinks) == 1 or not settings["sinks_parallel"]:
+        return [load_function(*args, sink.settings, sink.engine, sink.tables) 
+                for sink in sinks]
+
+    with ThreadPoolExecutor(max_workers=len(sinks)) as sink_pool:
+        futures = [sink_pool.submit(load_function, *args, sink.settings, 
+                                    sink.engine, sink.tables) 
+                   for sink in sinks]
+        return [future.result() for future in futures]
+
+#Upload data for a given dataset to every sink
+#Returns the number of rows loaded
+def upload_to_sinks(sf, df, dataset, settings, sinks):
+    return run_on_sinks(upload_data, (sf, df, dataset), settings, sinks)[0]
+
+#Replace the whole content of a dataset's table (and its rollup) in a single
+#transaction so readers never see a partly rebuilt table
+def replace_table(df, dataset, settings, engine, tables):
+    from sqlalchemy import delete
+    from utils.data_loading import bulk_insert
+
+    sqlalc_table = tables[settings["sql_table_" + dataset.lower()]]
+
+    with engine.begin() as con:
+        with report.stage("delete", table=sqlalc_table.name) as metrics:
+            result = con.execute(delete(sqlalc_table))
+            metrics["rows_deleted"] = result.rowcount
+
+        bulk_insert(con, sqlalc_table, df,
+                    method=settings["load_method"],
+                    batch_size=settings["load_batch_size"],
+                    staging_dir=settings["load_staging_dir"])
+
+        update_rollup(con, None, dataset, settings, tables)
+
+    return len(df)
+
+#Recompute the rollup rows affected by the loaded dates
+#(in the same transaction as the load so the rollup always matches the data)
+#If no dates are given the whole rollup is rebuilt
+def update_rollup(con, dates, dataset, settings, tables):
+    from utils.rollups import refresh_rollup
+
+    if not settings["rollups_enabled"] or (dates is not None and 
+                                           len(dates) == 0):
+        return
+
+    refresh_rollup(con, tables[settings["sql_table_" + dataset.lower()]],
+                   tables[settings["sql_table_" + dataset.lower() + 
+                                   "_rollup"]],
+                   dataset,
+                   dates=dates,
+                   method=settings["load_method"],
+                   batch_size=settings["load_batch_size"],
+                   staging_dir=settings["load_staging_dir"])
+
+#Name used for each file type when cleansing filenames
+FILE_TYPE_NAMES = {
+    "Sickness": "Benchmarking",
+    "ByReason": "by Reason"
+}
+
+#Determine the file type of a source file from its columns (only the header 
+#and first rows are read) and the name used for the file type when cleansing 
+#filenames. Files that do not match a dataset or cannot be read are rejected 
+#(None is returned for both names).
+#The file is in the source directory unless another directory is given.
+def get_file_type(sf, settings, directory=None):
+    from utils.validation import classify_source_file
+
+    with report.stage("probe", file=sf):
+        file_type, problems, skipped = classify_source_file(
+            (directory or settings["source_directory"]) + sf, settings)
+
+    if file_type is None:
+        print(f"Warning: {sf} has been rejected and will not be processed:")
+        for problem in problems:
+            print("  - " + problem)
+        report.count("files_rejected")
+        return None, None
+
+    #Other csv files in a zip file (i.e. metadata) are not loaded
+    for member in skipped:
+        print(f"{sf}: {member} does not contain {file_type} data and will "
+              "be skipped.")
+
+    return file_type, FILE_TYPE_NAMES[file_type]
+
+#Work out the file type of each source file and which files need loading
+def prepare_jobs(source_files, ledger, settings):
+    jobs = []
+
+    for sf in source_files:
+
+        #Determine file type (and skip files that fail the probe)
+        file_type, file_cleanse = get_file_type(sf, settings)
+        if file_type is None:
+            continue
+
+        if settings["filename_cleanse"]:
+            filename = filename_cleanse(sf, file_cleanse, settings)
+        else:
+            filename = sf
+
+        #Check there was no conflict issue within the source data
+        ##(This can happen when attempting to cleanse the filename of a source 
+        ##file and its new name matches another source file)
+        if not filename:
+            continue
+
+        #Skip files that have already been loaded into every sink in the run
+        #(unless forced). A file missing from any sink is loaded into them all
+        #(reloading a file replaces its rows so this is safe).
+        with report.stage("hash", file=filename):
+            file_hash = get_file_hash(settings["source_directory"] + filename)
+        if (not settings["ingest_force"] and 
+            is_ingested(ledger, file_hash, file_type, settings["sinks"])):
+            print(f"{filename} has already been loaded and will be skipped.")
+            if settings["data_archive"]:
+                archive_file(filename, file_type, file_hash, settings)
+            continue
+
+        jobs.append((filename, file_type, file_hash))
+
+    return jobs
+
+#Read and transform a single source file
+#When the file hash is given the processed frame is cached so the file does
+#not need to be parsed again if it is reloaded
+def transform_source_file(filename, file_type, ics_lookup, settings,
+                          file_hash=None):
+    from utils.data_transform import (get_transform_key, 
+                                      process_benchmarking_data)
+    from utils.processed_cache import load_processed, save_processed
+    from utils.validation import get_dataset_members
+
+    #Use the processed frame from the cache if available
+    use_cache = settings["processed_cache"] and file_hash is not None
+    if use_cache:
+        cache_dir = settings["processed_cache_directory"]
+        cache_key = get_transform_key(file_hash, file_type, ics_lookup, 
+                                      settings)
+
+        with report.stage("cache_read", file=filename) as metrics:
+            df_processed = load_processed(cache_dir, cache_key)
+            metrics["hit"] = df_processed is not None
+
+        if df_processed is not None:
+            report.count("processed_cache_hits")
+            #The upload timestamp is for this load not the cached one
+            df_processed["date_upload"] = datetime.today()
+            validate_data(filename, df_processed, file_type, settings)
+            return df_processed
+        report.count("processed_cache_misses")
+
+    #Load the data (only the mapped columns for London are kept)
+    #Only the zip file members holding the dataset are read
+    filepath = settings["source_directory"] + filename
+    with report.stage("read", file=filename) as metrics:
+        df_source = read_source_file(
+            filepath, settings, 
+            get_dataset_members(filepath, file_type, settings))
+        metrics["rows_out"] = len(df_source)
+
+    #Transform the data
+    with report.stage("transform", file=filename) as metrics:
+        metrics["rows_in"] = len(df_source)
+        df_processed = process_benchmarking_data(
+            df_source, file_type, ics_lookup, settings)
+        metrics["rows_out"] = len(df_processed)
 
-    # Pack the buttons
-    yes_button.pack(side="left", padx=50, pady=15)
-    no_button.pack(side="right", padx=50, pady=15)
+    #Check the data before it is cached or loaded
+    validate_data(filename, df_processed, file_type, settings)
 
-    # Allow the window to resize based on its content
-    dialog.update_idletasks()
-    dialog.resizable(False, False)  
+    #Save the processed frame for future reloads
+    if use_cache:
+        with report.stage("cache_write", file=filename):
+            save_processed(df_processed, cache_dir, cache_key)
 
-    # Wait for the dialog to close
-    dialog.wait_window()
+    return df_processed
 
-    #Check if the user used the "Apply to all" option
-    global overwrite_warning
-    overwrite_warning = not apply_to_all_var.get()
+#Check the processed data can be loaded into the destination table
+#(primary key, NOT NULL and length constraints from the table definition)
+#An exception listing every violation is raised so a file with bad rows is
+#not partly loaded
+def validate_data(filename, df, file_type, settings):
+    from utils.validation import format_violations, validate_processed
 
-    # Return the result and the checkbox state
-    return bool(int(result.get()))
+    if not settings["validate_enabled"]:
+        return
 
-#Function that handles the file archiving
-def archive_file(filename, settings):
+    with report.stage("validate", file=filename) as metrics:
+        metrics["rows_in"] = len(df)
+        violations = validate_processed(df, file_type, settings)
+        metrics["violations"] = sum(rows for _, _, rows, _ in violations)
 
-    #Load settings
-    active_dir = settings["source_directory"]
-    archive_dir = settings["archive_directory"]
+    if violations:
+        report.count("files_invalid")
+        raise Exception(format_violations(filename, violations))
 
-    #Check for conflict
-    file_source = active_dir + filename
-    file_dest = archive_dir + filename
+#Read and transform a source file in a worker process
+#The run report measurements are returned so they can be added to the run
+def transform_source_file_worker(filename, file_type, ics_lookup, settings,
+                                 file_hash=None):
+    #Clear any measurements inherited from the parent process
+    report.drain()
 
-    ##Conflict found
-    if os.path.isfile(file_dest):
-        #Check if the user should be prompted
-        global overwrite
-        if overwrite_warning:
-            overwrite = overwrite_prompt(filename)
+    df_processed = transform_source_file(
+        filename, file_type, ics_lookup, settings, file_hash)
 
-        #Check if the overwrite should occur
-        if overwrite:
-            os.remove(file_dest)
-            os.rename(file_source, file_dest)
+    return df_processed, report.drain()
 
-    ##No conflict, can archive as normal 
-    else:
-        #Archive the file
-        os.rename(file_source, file_dest)
+#Record a loaded file in the ledger and archive it
+def finish_job(job, rows, ledger, settings):
+    filename, file_type, file_hash = job
 
-#Function to upload data for a given dataset
-def upload_data(sf, df, dataset, settings):
-
-    #Convert float columns to objects (Needed for dealing with NaNs)
-    df = df.astype(object).where(pd.notnull(df), None)
+    #Record the file in the ledger so it is not loaded again
+    record_ingest(ledger, file_hash, file_type, filename, rows, 
+                  settings["sinks"])
+    save_ledger(ledger, settings["ingest_ledger"])
 
-    #Load destination table name
-    try:
-        sql_table = settings["sql_table_" + dataset.lower()]
-    except:
-        raise Exception((f"'sql_table_{dataset}' was not found in the"
-                          "'[database]' section of the config.toml file."))
+    #Archive the file after upload if enabled
+    if settings["data_archive"]:
+        with report.stage("archive", file=filename):
+            archive_file(filename, file_type, file_hash, settings)
 
-    #Set up Database Connection
-    dsn = settings["sql_dsn"]
-    sql_database = settings["sql_database"]
+#Process the source files one at a time
+def process_files(jobs, ics_lookup, ledger, settings, sinks):
+    for job in jobs:
+        filename, file_type, file_hash = job
+        print(filename)
 
-    #Connect to the database
-    engine = db_connect(dsn, sql_database)
+        df_processed = transform_source_file(
+            filename, file_type, ics_lookup, settings, file_hash)
 
-    #Upload the processed data
-    sql_schema = settings["sql_schema"]
-    batch_size = 200
+        #Load the data into the warehouse
+        rows = upload_to_sinks(filename, df_processed, file_type, settings, 
+                               sinks)
+
+        finish_job(job, rows, ledger, settings)
+
+#Process the source files as a pipeline
+#Files are read and transformed in a process pool while earlier files are
+#uploaded. Each dataset has its own upload thread so the Sickness and ByReason
+#tables load in parallel while the files for a table still load in order.
+#Ledger updates and archiving happen on the main thread once a file is loaded.
+def process_files_pipelined(jobs, ics_lookup, ledger, settings, sinks):
+    workers = settings["pipeline_workers"]
     
-    ##Delete existing overlapping data to allow for re-uploading
-    data_daterange = df["date_data"].unique()
-    if len(data_daterange) > 1:
-        raise Warning(("Multiple dates were found in the data.\n"
-                      "This process does not replace existing data in the "
-                      "destination for files with multiple dates."))
-            
-    rows = df.to_dict(orient="records")
+    #Limit how many processed frames can be held in memory at once
+    max_pending = workers * 2
+    upload_slots = threading.BoundedSemaphore(max_pending)
+
+    transforms = deque()
+    uploads = deque()
+    upload_lanes = {}
+
+    #Finish every upload at the front of the queue that has completed
+    def finish_uploads(wait=False):
+        while uploads and (wait or uploads[0][1].done()):
+            job, future = uploads.popleft()
+            finish_job(job, future.result(), ledger, settings)
+
+    #Hand a transformed file over to the upload thread for its dataset
+    def queue_upload(job, df_processed):
+        filename, file_type, file_hash = job
+        if file_type not in upload_lanes:
+            upload_lanes[file_type] = ThreadPoolExecutor(max_workers=1)
+        
+        upload_slots.acquire()
+        future = upload_lanes[file_type].submit(
+            upload_to_sinks, filename, df_processed, file_type, settings, 
+            sinks)
+        future.add_done_callback(lambda f: upload_slots.release())
+        uploads.append((job, future))
+
+    #Collect a transformed file (and its measurements) from the process pool
+    def queue_transformed(job, future):
+        df_processed, (stages, counters) = future.result()
+        report.merge(stages, counters)
+        queue_upload(job, df_processed)
 
-    metadata = MetaData(schema=sql_schema)
-    metadata.reflect(bind=engine)
-    sqlalc_table = metadata.tables[sql_schema + '.' + sql_table]
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as transform_pool:
+            for job in jobs:
+                filename, file_type, file_hash = job
+                print(filename)
+
+                transforms.append((job, transform_pool.submit(
+                    transform_source_file_worker, filename, file_type, 
+                    ics_lookup, settings, file_hash)))
+                
+                #Pass the oldest transformed file on once the queue is full
+                if len(transforms) >= max_pending:
+                    job_done, future = transforms.popleft()
+                    queue_transformed(job_done, future)
+                
+                finish_uploads()
+
+            #Pass on the remaining transformed files in order
+            while transforms:
+                job_done, future = transforms.popleft()
+                queue_transformed(job_done, future)
+                finish_uploads()
+
+        finish_uploads(wait=True)
+
+    finally:
+        for lane in upload_lanes.values():
+            lane.shutdown(wait=True)
+
+#Get the source files that need loading
+def get_jobs(settings):
+    ##Get the datafile(s)
+    source_files = get_source_files(settings)
+
+    #Load the record of files that have already been loaded
+    ledger = load_ledger(settings["ingest_ledger"])
+
+    #Work out which files need loading before connecting to the database
+    return prepare_jobs(source_files, ledger, settings), ledger
+
+#Command: download new source files from NHSD
+def scrape_command(settings):
+    with report.stage("scrape"):
+        scrape_new_data(settings)
+
+#Command: transform the source files into the processed cache without
+#loading them so the load can be run later (or elsewhere)
+def process_command(settings):
+    if not settings["processed_cache"]:
+        raise Exception(("The process command requires the processed cache. "
+                         "Enable it in the [processed_cache] section of the "
+                         "config.toml file."))
+    print("\nBegin processing...")
+
+    jobs, ledger = get_jobs(settings)
+    if jobs == []:
+        print("\nNo new files to process.\n")
+        return
+
+    #The database is only queried if the cached ICS lookup has expired
+    with report.stage("ics_lookup"):
+        ics_lookup = get_ics_lookup(settings)
+
+    #Transform the files in parallel when the pipeline is enabled
+    if settings["pipeline_enabled"] and len(jobs) > 1:
+        with ProcessPoolExecutor(
+            max_workers=settings["pipeline_workers"]) as transform_pool:
+            futures = [transform_pool.submit(transform_source_file_worker, 
+                                             filename, file_type, ics_lookup, 
+                                             settings, file_hash)
+                       for filename, file_type, file_hash in jobs]
+            for job, future in zip(jobs, futures):
+                print(job[0])
+                _, (stages, counters) = future.result()
+                report.merge(stages, counters)
+    else:
+        for filename, file_type, file_hash in jobs:
+            print(filename)
+            transform_source_file(filename, file_type, ics_lookup, settings,
+                                  file_hash)
 
-    with engine.connect() as con:
+    print("\nFinished processing.\n")
 
-        #If there is only a single date in the data
-        if len(data_daterange) == 1:
-            #Create delete query to remove existing data for this data point
-            del_query = (f"DELETE FROM "
-                        f"[{sql_database}].[{sql_schema}].[{sql_table}] "
-                        f"WHERE date_data = '{data_daterange[0]}'")
-    
-            #Delete existing data from the destination
-            con.execute(text(del_query))
-        
-        #Group the data into batches and upload
-        for i in range(0, len(rows), batch_size):
-            batch = rows[i:i+batch_size]
-            result = con.execute(
-                insert(sqlalc_table),
-                batch
-            )
+#Command: load the source files into the warehouse
+#(processed files are taken from the processed cache when available)
+def load_command(settings):
+    from utils.data_scraping import clear_checkpoint
 
-        con.commit()
+    print("\nBegin processing...")
 
-    #Archive the file after upload if enabled
-    if settings["data_archive"]:
-        archive_file(sf, settings)
+    jobs, ledger = get_jobs(settings)
+    if jobs == []:
+        print("\nNo new files to process.\n")
+        clear_checkpoint(settings["scrape_checkpoint"])
+        return
 
-#Load the runtime settings
-settings = load_settings()
+    #Connect to the sinks and load the destination table definitions
+    #(a single pooled engine is shared for the run by each sink)
+    with report.stage("reflection"):
+        sinks = connect_sinks(settings)
 
-#Extract the data from the source
-##If enabled, scrape new data from NHSD
-if settings["scrape_new_data"]:
-    scrape_new_data(settings)
+    #Load the ICS lookup (from the local cache when it is still valid)
+    with report.stage("ics_lookup"):
+        ics_lookup = get_ics_lookup(settings, get_warehouse_engine(sinks))
 
-#Set the overwrite settings
-overwrite_warning = settings["overwrite_warning"]
-if not overwrite_warning:
-    overwrite = settings["overwrite_default"]
+    if settings["pipeline_enabled"] and len(jobs) > 1:
+        process_files_pipelined(jobs, ics_lookup, ledger, settings, sinks)
+    else:
+        process_files(jobs, ics_lookup, ledger, settings, sinks)
 
-##Get the datafile(s)
-source_files = get_source_files(settings)
+    #The backfill (if any) is complete once every file is loaded
+    clear_checkpoint(settings["scrape_checkpoint"])
 
-#Load the ICS lookup
-ics_lookup = get_ics_lookup(settings)
+    print("\nFinished processing.\n")
 
-print("\nBegin processing...")
+#Command: archive the source files that have already been loaded
+def archive_command(settings):
+    store_loose_files(settings)
+    ledger = load_ledger(settings["ingest_ledger"])
 
-for sf in source_files:
+    for sf in get_source_files(settings):
+        file_type, _ = get_file_type(sf, settings)
+        if file_type is None:
+            continue
+        file_hash = get_file_hash(settings["source_directory"] + sf)
 
-    #Determine file type (using filename, relies on assumption)
-    if "reason" in sf.lower():
-        file_type = "ByReason"
-        file_cleanse = "by Reason"
-    else:
-        file_type = "Sickness"
-        file_cleanse = "Benchmarking"
+        if not is_ingested(ledger, file_hash, file_type, settings["sinks"]):
+            print(f"{sf} has not been loaded yet and will not be archived.")
+            continue
 
-    if settings["filename_cleanse"]:
-        filename = filename_cleanse(sf, file_cleanse, settings)
-    else:
-        filename = sf
+        with report.stage("archive", file=sf):
+            archived = archive_file(sf, file_type, file_hash, settings)
+        if archived:
+            print(f"{sf} has been archived.")
+        else:
+            print(f"{sf} is already in the archive and has been removed.")
 
-    #Check there was no conflict issue within the source data
-    ##(This can happen when attempting to cleanse the filename of a source file
-    ##and its new name matches another source file)
-    if filename:
-        print(filename)
+#Move files saved directly in the archive directory (before the archive store
+#was added) into the store, oldest first so their revisions are in order
+def store_loose_files(settings):
+    from utils.archive_store import store_file
+    from utils.validation import get_file_periods
+
+    archive_dir = settings["archive_directory"]
+    if not os.path.isdir(archive_dir):
+        return
+
+    loose_files = [sf for sf in os.listdir(archive_dir) 
+                   if sf.lower().endswith((".csv", ".zip"))]
+    for sf in sorted(loose_files, 
+                     key=lambda sf: os.path.getmtime(archive_dir + sf)):
+        file_type, _ = get_file_type(sf, settings, archive_dir)
+        if file_type is None:
+            continue
+        periods = get_file_periods(archive_dir + sf, file_type, settings)
+
+        with report.stage("archive", file=sf):
+            store_file(archive_dir + sf, get_file_hash(archive_dir + sf), 
+                       file_type, periods, archive_dir, settings["archive_compress_level"],
+                       datetime.fromtimestamp(
+                           os.path.getmtime(archive_dir + sf)))
+        print(f"{sf} has been moved into the archive store.")
+
+#Get the revisions in the archive needed to rebuild each dataset
+#(NHSD republish months so files whose months are all in newer releases are
+#skipped). Revisions are ordered by the latest month of their data rather than
+#when they were archived, so an older release archived later (i.e. when 
+#backfilling) never replaces the rows of a newer one.
+#Returns a list of jobs (object path, file_type, file_hash), newest release 
+#first for each dataset, and the original name of each file
+def get_archive_jobs(settings):
+    from utils.archive_store import get_rebuild_revisions, load_index
+
+    store_loose_files(settings)
+    index = load_index(settings["archive_directory"])
+    revisions = get_rebuild_revisions(index)
+
+    jobs = []
+    names = {}
+    for file_type in sorted(revisions):
+        #The newer release that was archived first
+        first_archived = None
+        for file_hash, entry in revisions[file_type]:
+            jobs.append((entry["object"], file_type, file_hash))
+            names[entry["object"]] = entry["names"][-1]
+
+            #Report releases that were archived after a newer release
+            if (first_archived is not None and 
+                entry["archived"] > first_archived["archived"]):
+                print(f"{entry['names'][-1]} was archived after "
+                      f"{first_archived['names'][-1]} but is an older "
+                      "release so its rows are only used for months not in "
+                      "newer releases.")
+            if (first_archived is None or 
+                entry["archived"] < first_archived["archived"]):
+                first_archived = entry
+
+        skipped = (sum(entry["dataset"] == file_type 
+                       for entry in index.values()) - 
+                   len(revisions[file_type]))
+        if skipped > 0:
+            print(f"{skipped} earlier revisions of the {file_type} data will "
+                  "be skipped as all their months are in newer releases.")
+
+    return jobs, names
+
+#Remove the rows of each month that is also in a newer release
+#The frames are newest release first (see get_archive_jobs) so only the 
+#newest rows of each month are kept (NHSD publish files that overlap i.e. Jul
+#to Sep then Sep)
+#Returns the frames and the rows kept from each
+def drop_superseded_rows(dfs, filenames, names):
+    seen_dates = set()
+    kept = []
+    rows = []
+    for df, filename in zip(dfs, filenames):
+        dates = df["date_data"].unique()
+        superseded = df["date_data"].isin(seen_dates)
+        if superseded.any():
+            print(f"{superseded.sum():,} rows of {names[filename]} are in a "
+                  "newer release and will be skipped.")
+            df = df[~superseded]
+            report.count("rows_superseded", int(superseded.sum()))
+        seen_dates.update(dates)
+        kept.append(df)
+        rows.append(len(df))
+
+    return kept, rows
+
+#Command: rebuild the tables from the archive
+#Every revision with a month not in a newer revision is transformed (in 
+#parallel when the pipeline is enabled, using the processed cache), the rows of
+#each month are taken from its newest revision then each table and its rollup 
+#is replaced in a single bulk load and transaction
+def rebuild_command(settings):
+    import pandas as pd
+
+    print("\nBegin rebuild...")
+
+    jobs, names = get_archive_jobs(settings)
+    if jobs == []:
+        print("\nNo files were found in the archive.\n")
+        return
+
+    #The files are read (and decompressed) from the archive store
+    archive_settings = {**settings, 
+                        "source_directory": settings["archive_directory"]}
+
+    #Connect to the sinks and load the destination table definitions
+    with report.stage("reflection"):
+        sinks = connect_sinks(settings)
+
+    with report.stage("ics_lookup"):
+        ics_lookup = get_ics_lookup(settings, get_warehouse_engine(sinks))
+
+    #Transform every file
+    frames = {}
+    filenames = {}
+    rows = {}
+    if settings["pipeline_enabled"] and len(jobs) > 1:
+        with ProcessPoolExecutor(
+            max_workers=settings["pipeline_workers"]) as transform_pool:
+            futures = [transform_pool.submit(transform_source_file_worker, 
+                                             filename, file_type, ics_lookup, 
+                                             archive_settings, file_hash)
+                       for filename, file_type, file_hash in jobs]
+            for (filename, file_type, _), future in zip(jobs, futures):
+                print(names[filename])
+                df_processed, (stages, counters) = future.result()
+                report.merge(stages, counters)
+                frames.setdefault(file_type, []).append(df_processed)
+                filenames.setdefault(file_type, []).append(filename)
+    else:
+        for filename, file_type, file_hash in jobs:
+            print(names[filename])
+            df_processed = transform_source_file(
+                filename, file_type, ics_lookup, archive_settings, file_hash)
+            frames.setdefault(file_type, []).append(df_processed)
+            filenames.setdefault(file_type, []).append(filename)
+
+    #Replace each table with the combined data
+    for file_type, dfs in frames.items():
+        dfs, file_rows = drop_superseded_rows(dfs, filenames[file_type], names)
+        rows.update(zip(filenames[file_type], file_rows))
+
+        with report.stage("concat", dataset=file_type) as metrics:
+            df_rebuild = pd.concat(dfs, ignore_index=True)
+            metrics["rows_out"] = len(df_rebuild)
+
+        #Check the files do not overlap
+        validate_data(f"the {file_type} rebuild", df_rebuild, file_type, 
+                      settings)
+
+        print(f"\nReplacing the {file_type} table with {len(df_rebuild):,} "
+              f"rows from {len(dfs)} files")
+        run_on_sinks(replace_table, (df_rebuild, file_type), settings, sinks)
+
+    #Record the rebuilt files in the ledger
+    ledger = load_ledger(settings["ingest_ledger"])
+    for filename, file_type, file_hash in jobs:
+        record_ingest(ledger, file_hash, file_type, names[filename], 
+                      rows[filename], settings["sinks"])
+    save_ledger(ledger, settings["ingest_ledger"])
+
+    print("\nFinished rebuild.\n")
+
+#Get the size and modified time of each csv (and zip) file in the source 
+#directory (files still being downloaded are skipped)
+def get_file_signatures(settings):
+    data_dir = settings["source_directory"]
 
-        #Load the data
-        df_source = pd.read_csv(settings["source_directory"] + filename)
+    signatures = {}
+    for sf in os.listdir(data_dir):
+        if not sf.lower().endswith((".csv", ".zip")):
+            continue
+        try:
+            stat = os.stat(data_dir + sf)
+        except FileNotFoundError:
+            #The file was moved (i.e. archived) while the directory was read
+            continue
+        signatures[sf] = (stat.st_size, stat.st_mtime)
+
+    return signatures
+
+#Command: keep running and load new source files as they arrive
+#The sinks (engine and reflected tables), the ICS lookup and the ledger are 
+#loaded once and kept for every file. A file is only loaded once its size and 
+#modified time have not changed for the debounce time so files that are still
+#being copied in are not read. NHSD is scraped on a schedule when scraping is
+#enabled. Stop the watch with Ctrl+C.
+def watch_command(settings):
+    poll_seconds = settings["watch_poll_seconds"]
+    debounce_seconds = settings["watch_debounce_seconds"]
+    scrape_seconds = settings["watch_scrape_minutes"] * 60
+    scrape_enabled = settings["scrape_new_data"] and scrape_seconds > 0
+
+    #The page cache is not used by the scheduled scrapes as a cached 
+    #publication listing would hide a release made since the last scrape
+    scrape_settings = {**settings, "scrape_page_cache_ttl": 0}
+
+    ledger = load_ledger(settings["ingest_ledger"])
+
+    with report.stage("reflection"):
+        sinks = connect_sinks(settings)
+
+    with report.stage("ics_lookup"):
+        ics_lookup = get_ics_lookup(settings, get_warehouse_engine(sinks))
+    lookup_loaded = time.monotonic()
+
+    #Files that have been handled (loaded, skipped or rejected) and files 
+    #waiting for the debounce, with their signatures
+    handled = {}
+    pending = {}
+    last_scrape = None
+
+    print(f"\nWatching {os.path.abspath(settings['source_directory'])} "
+          "for new files (press Ctrl+C to stop)...")
 
-        #Transform the data
-        df_processed = process_benchmarking_data(
-            df_source, file_type, ics_lookup, settings)
+    try:
+        while True:
+            now = time.monotonic()
+
+            #Scrape NHSD for new releases on schedule
+            #(downloads are only renamed into the directory once complete)
+            if scrape_enabled and (last_scrape is None or 
+                                   now - last_scrape >= scrape_seconds):
+                last_scrape = now
+                try:
+                    scrape_command(scrape_settings)
+                except Exception as e:
+                    print(f"Warning: The scrape failed and will be retried "
+                          f"in {settings['watch_scrape_minutes']} minutes "
+                          f"({e}).")
+
+            #Find the new (or changed) files that have stopped changing
+            signatures = get_file_signatures(settings)
+            ready = []
+            for sf, signature in signatures.items():
+                if handled.get(sf) == signature:
+                    continue
+                if sf not in pending or pending[sf][0] != signature:
+                    pending[sf] = (signature, now)
+                elif now - pending[sf][1] >= debounce_seconds:
+                    ready.append(sf)
+            for sf in list(pending):
+                if sf not in signatures:
+                    del pending[sf]
+
+            if ready:
+                #Refresh the ICS lookup once it is older than its TTL
+                if (now - lookup_loaded) / 3600 >= settings["ics_lookup_ttl"]:
+                    with report.stage("ics_lookup"):
+                        ics_lookup = get_ics_lookup(
+                            settings, get_warehouse_engine(sinks))
+                    lookup_loaded = now
+
+                filenames = process_new_files(sorted(ready), ics_lookup, 
+                                              ledger, settings, sinks)
+
+                #Files left in the directory (i.e. failed files or files that
+                #are not archived) are only loaded again if they change
+                signatures = get_file_signatures(settings)
+                for sf in ready + filenames:
+                    pending.pop(sf, None)
+                    if sf in signatures:
+                        handled[sf] = signatures[sf]
+
+                #Save a report for each batch of files
+                report_path = report.write(settings["report_directory"])
+                print(f"Run report saved to {report_path}")
+                report.start(trace_memory=settings["report_trace_memory"],
+                             profile=settings["report_profile"])
+
+                print("\nWaiting for new files...")
+
+            time.sleep(poll_seconds)
+
+    except KeyboardInterrupt:
+        print("\nStopped watching.\n")
+
+#Load a batch of new files found by the watch
+#A file that fails is reported and the watch carries on with the next file
+#Returns the names of the files after cleansing
+def process_new_files(source_files, ics_lookup, ledger, settings, sinks):
+    print(f"\n{datetime.now():%Y-%m-%d %H:%M:%S} Found {len(source_files)} "
+          "new files")
 
-        #Load the data into the warehouse
-        upload_data(filename, df_processed, file_type, settings)
+    try:
+        jobs = prepare_jobs(source_files, ledger, settings)
+    except Exception as e:
+        report.count("watch_failures")
+        print(f"Warning: The new files could not be checked:\n{e}")
+        return []
+
+    #The pipeline loads the batch together, otherwise each file is loaded on
+    #its own so one bad file does not stop the others
+    if settings["pipeline_enabled"] and len(jobs) > 1:
+        batches = [jobs]
+    else:
+        batches = [[job] for job in jobs]
+
+    for batch in batches:
+        try:
+            if len(batch) > 1:
+                process_files_pipelined(batch, ics_lookup, ledger, settings,
+                                        sinks)
+            else:
+                process_files(batch, ics_lookup, ledger, settings, sinks)
+        except Exception as e:
+            report.count("watch_failures")
+            print(f"Warning: {', '.join(job[0] for job in batch)} could not "
+                  f"be loaded:\n{e}")
+
+    return [filename for filename, _, _ in jobs]
+
+#Command: run the full process, scrape (if enabled), transform and load
+def run(settings):
+    #Extract the data from the source
+    ##If enabled, scrape new data from NHSD
+    if settings["scrape_new_data"]:
+        scrape_command(settings)
+
+    load_command(settings)
+
+#The commands available from the command line
+COMMANDS = {
+    "run": run,
+    "scrape": scrape_command,
+    "process": process_command,
+    "load": load_command,
+    "archive": archive_command,
+    "rebuild": rebuild_command,
+    "watch": watch_command
+}
+
+#Run a command (argv defaults to the command line arguments)
+def main(argv=None):
+    args = parse_args(argv)
+
+    #Load the runtime settings (once for the whole run)
+    settings = load_settings(args)
+
+    #Record the time taken by each stage of the run
+    report.start(trace_memory=settings["report_trace_memory"],
+                 profile=settings["report_profile"])
+    try:
+        COMMANDS[args.command](settings)
+    finally:
+        report_path = report.write(settings["report_directory"])
+        print(f"Run report saved to {report_path}")
 
-print("\nFinished processing.\n")
\ No newline at end of file
+if __name__ == "__main__":
+    main()